@@ -0,0 +1,192 @@
+"""Post-processing benchmark for miyuki.
+
+Generates synthetic MPEG-TS segments with FFmpeg's lavfi sources, lays them out the way the
+downloader does (<root>/<movie>/video<i>.jpeg) and runs every post-processing path on them:
+
+    concat          raw binary concatenation (video_write_jpegs_to_mp4)
+    ffmpeg-copy     FFmpeg concat demuxer, streams copied (generate_mp4_by_ffmpeg)
+    ffmpeg-<enc>    FFmpeg concat demuxer, video re-encoded with every usable encoder
+                    that the encoder selection of -video-reencode would consider
+
+Each path runs in its own process, so wall time, CPU time (user + system, FFmpeg included)
+and peak RSS are measured per path. Generated segments are kept in the work directory and
+reused by later runs with the same parameters.
+
+    python benchmarks/postprocess.py
+    python benchmarks/postprocess.py --resolutions 720,1080 --segments 100,400 --json results.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS and CPU time are reported as n/a there
+    resource = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from miyuki import miyuki
+
+RESOLUTIONS = {
+    '360': '640x360',
+    '480': '854x480',
+    '720': '1280x720',
+    '1080': '1920x1080',
+    '2160': '3840x2160',
+}
+SEGMENT_DURATION = 2
+
+
+def generate_segments(work_dir, resolution, segment_count):
+    # Returns the movie name of a folder holding segment_count TS segments of SEGMENT_DURATION seconds
+    movie_name = f'bench-{resolution}p-{segment_count}'
+    movie_dir = os.path.join(work_dir, movie_name)
+    if os.path.exists(os.path.join(movie_dir, f'video{segment_count - 1}.jpeg')):
+        return movie_name
+    shutil.rmtree(movie_dir, ignore_errors=True)
+    os.makedirs(movie_dir)
+
+    video_codec = 'libx264' if 'libx264' in list(miyuki.ffmpeg_get_encoders('V', ('libx264',))) else 'mpeg2video'
+    print(f"Generating {segment_count} segments at {resolution}p with {video_codec}...")
+    ffmpeg_command = [
+        'ffmpeg',
+        '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={RESOLUTIONS[resolution]}:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(segment_count * SEGMENT_DURATION),
+        '-c:v', video_codec,
+        '-g', str(30 * SEGMENT_DURATION),
+        '-c:a', 'aac',
+        '-f', 'segment',
+        '-segment_time', str(SEGMENT_DURATION),
+        '-segment_format', 'mpegts',
+        os.path.join(movie_dir, 'video%d.jpeg'),
+    ]
+    if video_codec == 'libx264':
+        ffmpeg_command[ffmpeg_command.index('-g'):ffmpeg_command.index('-g')] = ['-preset', 'ultrafast']
+    subprocess.run(ffmpeg_command, check=True, stdin=subprocess.DEVNULL)
+    return movie_name
+
+
+def run_one(work_dir, path, movie_name, segment_count):
+    # Runs a single post-processing path, called in a child process by run_path
+    miyuki.movie_save_path_root = work_dir
+    video_offset_max = segment_count - 1
+    final_file_name = f'{movie_name}-{path}'
+    output_file = os.path.join(work_dir, final_file_name + '.mp4')
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    if path == 'concat':
+        miyuki.video_write_jpegs_to_mp4(movie_name, video_offset_max, final_file_name)
+    elif path == 'ffmpeg-copy':
+        miyuki.generate_input_txt(movie_name, video_offset_max)
+        miyuki.generate_mp4_by_ffmpeg(movie_name, final_file_name, False, False, False)
+    else:
+        miyuki.generate_input_txt(movie_name, video_offset_max)
+        encoder = path[len('ffmpeg-'):]
+        miyuki.generate_mp4_by_ffmpeg(movie_name, final_file_name, False, True, False, video_encoder=encoder)
+
+
+def run_path(work_dir, path, movie_name, segment_count):
+    output_file = os.path.join(work_dir, f'{movie_name}-{path}.mp4')
+    command = [sys.executable, os.path.abspath(__file__), '--work-dir', work_dir,
+               '--run-one', path, '--movie', movie_name, '--segment-count', str(segment_count)]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if resource is not None and hasattr(os, 'wait4'):
+        # wait4 reports the child's usage including the FFmpeg process it waited for
+        stderr = process.stderr.read()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        wall_time = time.perf_counter() - start
+        cpu_time = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    else:
+        _, stderr = process.communicate()
+        wall_time = time.perf_counter() - start
+        cpu_time = None
+        peak_rss = None
+
+    if process.returncode != 0:
+        print(stderr.decode('utf-8', errors='replace'), file=sys.stderr)
+        return {'path': path, 'error': f'exit code {process.returncode}'}
+
+    result = {
+        'path': path,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'peak_rss': peak_rss,
+        'output_size': os.path.getsize(output_file),
+    }
+    os.remove(output_file)
+    return result
+
+
+def format_size(size):
+    if size is None:
+        return 'n/a'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post-processing benchmark for miyuki.')
+    parser.add_argument('--work-dir', default=os.path.join(REPO_ROOT, 'bench_work'), help='Directory for the synthetic segments')
+    parser.add_argument('--resolutions', default='360,720,1080', help='Comma separated, from ' + ','.join(RESOLUTIONS))
+    parser.add_argument('--segments', default='50,200', help='Comma separated segment counts')
+    parser.add_argument('--paths', default=None, help='Comma separated paths to run (default: all)')
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--movie', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--segment-count', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        run_one(args.work_dir, args.run_one, args.movie, args.segment_count)
+        return
+
+    if shutil.which('ffmpeg') is None:
+        print('FFmpeg is required to generate the segments and to run the FFmpeg paths.', file=sys.stderr)
+        sys.exit(1)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    paths = ['concat', 'ffmpeg-copy'] + ['ffmpeg-' + x for x in miyuki.ffmpeg_usable_encoders('V', ('hevc', 'h264'))]
+    if args.paths is not None:
+        paths = [x for x in paths if x in args.paths.split(',')]
+
+    results = []
+    print(f"{'case':<22} {'path':<24} {'wall':>9} {'cpu':>9} {'peak rss':>11} {'output':>11}")
+    for resolution in args.resolutions.split(','):
+        for segment_count in map(int, args.segments.split(',')):
+            movie_name = generate_segments(args.work_dir, resolution, segment_count)
+            for path in paths:
+                result = run_path(args.work_dir, path, movie_name, segment_count)
+                result.update({'resolution': resolution, 'segments': segment_count})
+                results.append(result)
+                case = f'{resolution}p x {segment_count}'
+                if 'error' in result:
+                    print(f"{case:<22} {path:<24} failed: {result['error']}")
+                    continue
+                cpu_time = 'n/a' if result['cpu_time'] is None else f"{result['cpu_time']:.2f} s"
+                print(f"{case:<22} {path:<24} {result['wall_time']:>7.2f} s {cpu_time:>9} "
+                      f"{format_size(result['peak_rss']):>11} {format_size(result['output_size']):>11}")
+
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
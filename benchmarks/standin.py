@@ -0,0 +1,257 @@
+"""Stand-in harness for the proxy pool and the segment coordinator.
+
+Runs miyuki's segment download paths against local stand-ins instead of the real CDN:
+
+    proxy       segments fetched through two stand-in HTTP proxies with the proxy pool.
+                One proxy answers 502 until it is healed halfway through: it must get ejected
+                while broken, every segment must still arrive, and it must be back in rotation
+                (serving segments) once healed.
+    coordinator a segment coordinator in this process hands a movie out to two `miyuki -worker`
+                processes; every segment must arrive intact, downloaded by the workers.
+
+The stand-in CDN is passed to this process and to the workers through MIYUKI_CDN.
+
+    python benchmarks/standin.py
+    python benchmarks/standin.py --segments 200 --scenarios proxy
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+UUID = '00000000-0000-4000-8000-000000000000'
+RESOLUTION = '720p'
+SEGMENT_SIZE = 64 * 1024
+RECOVERY_TIMEOUT = 60
+
+
+def segment_content(index):
+    # Deterministic and different for every segment, so a misplaced segment is noticed
+    seed = hashlib.sha256(f'{UUID}/{RESOLUTION}/{index}'.encode('utf-8')).digest()
+    return seed * (SEGMENT_SIZE // len(seed))
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.lock = threading.Lock()
+        self.served = 0
+        self.rejected = 0
+        self.broken = False
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+    def count(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CdnHandler(QuietHandler):
+    # /<uuid>/<resolution>/video<i>.jpeg, like the real CDN
+    def do_GET(self):
+        match = re.fullmatch(rf'/{UUID}/{RESOLUTION}/video(\d+)\.jpeg', self.path)
+        if match is None:
+            self.send_body(404, b'not found')
+            return
+        self.server.count('served')
+        self.send_body(200, segment_content(int(match.group(1))))
+
+
+class ProxyHandler(QuietHandler):
+    # Plain HTTP forward proxy, curl sends the absolute URL in the request line
+    def do_GET(self):
+        if self.server.broken:
+            self.server.count('rejected')
+            self.send_body(502, b'bad gateway')
+            return
+        with urllib.request.urlopen(self.path, timeout=10) as response:
+            body = response.read()
+        self.server.count('served')
+        self.send_body(200, body)
+
+
+class LogCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def count(self, prefix):
+        return sum(1 for x in self.messages if x.startswith(prefix))
+
+
+def fetch_segments(miyuki, indexes, threads):
+    # Same per-thread proxy leases as the segment download threads, returns the indexes that failed
+    failed = []
+    pending = list(indexes)
+    lock = threading.Lock()
+
+    def worker():
+        proxy_lease = miyuki.proxy_pool.lease()
+        try:
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    index = pending.pop(0)
+                content = miyuki.https_request_with_retry(miyuki.segment_url(UUID, RESOLUTION, index), 5, 0, 5, proxy_lease=proxy_lease)
+                if content != segment_content(index):
+                    with lock:
+                        failed.append(index)
+        finally:
+            proxy_lease.close()
+
+    thread_list = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    return failed
+
+
+def run_proxy(miyuki, cdn, segments, threads):
+    healthy = StandInServer(ProxyHandler)
+    flaky = StandInServer(ProxyHandler)
+    flaky.broken = True
+    pool = miyuki.proxy_pool
+    pool.configure([healthy.url, flaky.url])
+    # Short enough for a quick run, the behaviour is the same as with the defaults
+    pool.EJECT_COOLDOWN = 1
+    pool.REPIN_REQUESTS = 5
+    collector = LogCollector()
+    logging.getLogger().addHandler(collector)
+    try:
+        failed = fetch_segments(miyuki, range(segments), threads)
+        ejected = collector.count('Proxy ejected')
+        rejected_while_broken = flaky.rejected
+
+        # Keep downloading until the healed proxy has served its cool-down and passed its trial
+        flaky.broken = False
+        flaky_served_before = flaky.served
+        rounds = 0
+        deadline = time.monotonic() + RECOVERY_TIMEOUT
+        while time.monotonic() < deadline:
+            failed += fetch_segments(miyuki, range(segments), threads)
+            rounds += 1
+            if collector.count('Proxy recovered') > 0 and flaky.served > flaky_served_before:
+                break
+            time.sleep(0.5)
+        recovered = collector.count('Proxy recovered')
+    finally:
+        logging.getLogger().removeHandler(collector)
+        pool.configure([])
+        healthy.shutdown()
+        flaky.shutdown()
+
+    checks = {
+        'every segment arrived': not failed,
+        'broken proxy ejected': ejected > 0,
+        'healed proxy recovered': recovered > 0,
+        'healed proxy serves again': flaky.served > flaky_served_before,
+    }
+    print(f"proxy: {(1 + rounds) * segments} segments, {rejected_while_broken} requests rejected by the broken proxy, "
+          f"{ejected} ejections, healthy proxy served {healthy.served}, healed proxy served {flaky.served - flaky_served_before}")
+    return checks
+
+
+def run_coordinator(miyuki, cdn, segments, work_dir):
+    movie_name = 'standin'
+    miyuki.movie_save_path_root = work_dir
+    os.makedirs(os.path.join(work_dir, movie_name), exist_ok=True)
+    coordinator = miyuki.SegmentCoordinator('127.0.0.1:0')
+    command = [sys.executable, os.path.join(REPO_ROOT, 'miyuki', 'miyuki.py'), '-worker', coordinator.address]
+    workers = [subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(2)]
+    served_before = cdn.served
+    start = time.perf_counter()
+    try:
+        coordinator.run_job(UUID, RESOLUTION, movie_name, segments - 1, 5, 0, 5)
+        elapsed = time.perf_counter() - start
+        workers_alive = all(x.poll() is None for x in workers)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+        coordinator.shutdown()
+    print()
+
+    intact = 0
+    for index in range(segments):
+        with open(os.path.join(work_dir, movie_name, f'video{index}.jpeg'), 'rb') as file:
+            intact += file.read() == segment_content(index)
+    checks = {
+        'every segment arrived intact': intact == segments,
+        'workers stayed up': workers_alive,
+        # The coordinator only downloads itself after WORKER_IDLE_TIMEOUT without workers
+        'downloaded by the workers': elapsed < miyuki.SegmentCoordinator.WORKER_IDLE_TIMEOUT,
+        'each segment fetched once': cdn.served - served_before == segments,
+    }
+    print(f"coordinator: {segments} segments through 2 workers in {elapsed:.2f} s, {intact} intact")
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in harness for the proxy pool and the segment coordinator.')
+    parser.add_argument('--segments', type=int, default=60, help='Segments per run')
+    parser.add_argument('--threads', type=int, default=4, help='Download threads of the proxy scenario')
+    parser.add_argument('--scenarios', default='proxy,coordinator', help='Comma separated, from proxy,coordinator')
+    args = parser.parse_args()
+
+    # The proxy scenario reads the pool's ejection and recovery messages, only warnings reach the console
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    logging.getLogger().handlers[0].setLevel(logging.WARNING)
+    cdn = StandInServer(CdnHandler)
+    # Read by miyuki at import time, and inherited by the worker processes
+    os.environ['MIYUKI_CDN'] = cdn.url
+    from miyuki import miyuki
+
+    work_dir = tempfile.mkdtemp(prefix='miyuki-standin-')
+    checks = {}
+    try:
+        scenarios = args.scenarios.split(',')
+        if 'proxy' in scenarios:
+            checks.update(run_proxy(miyuki, cdn, args.segments, args.threads))
+        if 'coordinator' in scenarios:
+            checks.update(run_coordinator(miyuki, cdn, args.segments, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        cdn.shutdown()
+
+    for name, passed in checks.items():
+        print(f"{'ok' if passed else 'FAIL':<5} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Startup benchmark for the miyuki CLI.
+
+Measures the import time of miyuki.miyuki (python -X importtime) and the wall time of
+short invocations, and fails when the heavy modules that must stay lazy get imported
+at startup again or when the import time goes over budget.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20 --max-import-ms 80
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only imported when the feature that needs them is used
+LAZY_MODULES = ['curl_cffi', 'http.server', 'sqlite3', 'pstats', 'cProfile', 'socketserver', 'concurrent.futures', 'ctypes']
+
+INVOCATIONS = {
+    'help': ['-h'],
+    'invalid args': ['-urls', 'https://missav.ai/sw-950', '-limit', 'abc'],
+}
+
+
+def run_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def measure_import():
+    # Returns the cumulative import time of miyuki.miyuki in microseconds and every module imported with it
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import miyuki.miyuki'],
+                            capture_output=True, text=True, env=run_env(), check=True)
+    total_us = None
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        if not cumulative.strip().isdigit():
+            continue
+        modules.add(name)
+        if name == 'miyuki.miyuki':
+            total_us = int(cumulative)
+    return total_us, modules
+
+
+def measure_invocation(arguments):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'miyuki.miyuki'] + arguments,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=run_env())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark for the miyuki CLI.')
+    parser.add_argument('--runs', type=int, default=10, help='Number of runs per measurement')
+    parser.add_argument('--max-import-ms', type=float, default=None, help='Fail when the median import time is above this')
+    args = parser.parse_args()
+
+    import_times = []
+    imported_modules = set()
+    for _ in range(args.runs):
+        total_us, modules = measure_import()
+        import_times.append(total_us / 1000)
+        imported_modules |= modules
+    import_ms = statistics.median(import_times)
+    print(f"import miyuki.miyuki      median {import_ms:8.1f} ms   min {min(import_times):8.1f} ms")
+
+    for name, arguments in INVOCATIONS.items():
+        wall_times = [measure_invocation(arguments) * 1000 for _ in range(args.runs)]
+        print(f"miyuki {name:<18} median {statistics.median(wall_times):8.1f} ms   min {min(wall_times):8.1f} ms")
+
+    failed = False
+    eager_modules = [x for x in LAZY_MODULES if x in imported_modules]
+    if eager_modules:
+        print(f"FAIL: imported at startup but should be lazy: {', '.join(eager_modules)}")
+        failed = True
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(f"FAIL: import time {import_ms:.1f} ms is over the {args.max_import_ms:.1f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,85 @@
 import argparse
+import codecs
+import contextvars
+import errno
+import hashlib
+import importlib
+import json
 import logging
 import os
+import random
 import re
+import socket
 import subprocess
 import shutil
 import threading
 import time
 import sys
+import urllib.parse
+from collections import deque
+from contextlib import contextmanager
 from functools import cache
-from curl_cffi import requests
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='Miyuki - %(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+
+class LazyModule:
+    # Stands in for a module and imports it on first attribute access, so that short
+    # invocations (-h, argument errors, a single url) don't pay for what they never use.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+curl_cffi = LazyModule('curl_cffi')
+requests = LazyModule('curl_cffi.requests')
+cProfile = LazyModule('cProfile')
+pstats = LazyModule('pstats')
+socketserver = LazyModule('socketserver')
+concurrent_futures = LazyModule('concurrent.futures')
+sqlite3 = LazyModule('sqlite3')
+http_server = LazyModule('http.server')
+ctypes = LazyModule('ctypes')
 
 magic_number = 114514
 RECORD_FILE = 'downloaded_urls_miyuki.txt'
 FFMPEG_INPUT_FILE = 'ffmpeg_input_miyuki.txt'
 ERROR_RECORD_FILE = 'error_records_miyuki.txt'
-TMP_THML_FILE = 'tmp_movie_miyuki.html'
+SYNC_STATE_FILE = 'sync_state_miyuki.json'
+JOB_QUEUE_FILE = 'jobs_miyuki.db'
+SERVICE_ADDRESS = '127.0.0.1:8765'
 downloaded_urls = set()
 movie_save_path_root = '.'
 COVER_URL_PREFIX = 'https://fourhoi.com/'
-video_m3u8_prefix = 'https://surrit.com/'
+# Overridable through the environment, so a coordinator and its workers can be pointed at a mirror (or a test server) together
+video_m3u8_prefix = os.environ.get('MIYUKI_CDN', 'https://surrit.com/')
 video_playlist_suffix = '/playlist.m3u8'
 href_regex_movie_collection = r'<a class="text-secondary group-hover:text-primary" href="([^"]+)" alt="'
 href_regex_public_playlist = r'<a href="([^"]+)" alt="'
 href_regex_next_page = r'<a href="([^"]+)" rel="next"'
-match_uuid_pattern = r'm3u8\|([a-f0-9\|]+)\|com\|surrit\|https\|video'
-match_tags_section = r'<a href=\"([^\"]+)\" class=\"text-nord13 font-medium\">'
-# match_title_pattern = r'<h1 class="text-base lg:text-lg text-nord6">([^"]+)</h1>'
-match_title_pattern = r'<title>([^"]+)</title>'
+# Everything the movie page is read for, in one alternation so the page is scanned only once
+match_movie_metadata = re.compile(
+    r'm3u8\|(?P<uuid>[a-f0-9\|]+)\|com\|surrit\|https\|video'
+    r'|<title>(?P<title>[^<]+)</title>'
+    r'|<meta property="og:image" content="(?P<cover>[^"]+)"'
+    r'|<meta property="og:video:duration" content="(?P<duration>\d+)"'
+    r'|<a href="(?P<link>[^"]+)" class="text-nord13 font-medium">(?P<link_text>[^<]*)'
+)
+METADATA_MATCH_SPAN = 1024
 RESOLUTION_PATTERN = r'RESOLUTION=(\d+)x(\d+)'
 RETRY = 5
 DELAY = 2
 TIMEOUT = 10
+CACHE_SIZE_MB = 10240
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+CONCAT_BUFFER_SIZE = 8 * 1024 * 1024
+ORDER_POLICIES = ['listing', 'shortest', 'tags']
+PLAN_THREADS = 8
+SIZE_PROBE_SAMPLES = 4
+DISK_RESERVE_MB = 1024
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
 }
@@ -58,6 +101,10 @@ banner = """
 def display_progress_bar(max_value, counter):
     bar_length = 50
     current_value = counter.incrementAndGet()
+    if isinstance(counter, JobProgress):
+        # Service jobs run side by side, their progress is reported through the API instead
+        counter.total = max_value
+        return
     progress = current_value / max_value
     block = int(round(bar_length * progress))
     text = f"\rProgress: [{'#' * block + '-' * (bar_length - block)}] {current_value}/{max_value}"
@@ -84,10 +131,513 @@ class ThreadSafeCounter:
             return self._count
 
 
+class JobProgress(ThreadSafeCounter):
+    def __init__(self):
+        super().__init__()
+        self.total = None
+
+
 counter = ThreadSafeCounter()
+# The counter of the movie being downloaded in this context, the service gives every job its own
+current_counter = contextvars.ContextVar('current_counter', default=counter)
 
 
-def https_request_with_retry(request_url, retry, delay, timeout):
+class PhaseTracer:
+    # Collects timing spans for the movie currently being processed.
+    # Every method is a no-op until configure() is called with an output directory,
+    # so the download path pays nothing when -profile is not used.
+    def __init__(self):
+        self.enabled = False
+        self.cpu_profile = False
+        self.output_dir = None
+        self._lock = threading.Lock()
+        self._spans = []
+        self._stats = None
+        self._origin = time.perf_counter()
+        self._collected = contextvars.ContextVar('collected_spans', default=None)
+
+    def configure(self, output_dir, cpu_profile=False):
+        self.enabled = output_dir is not None
+        # Absolute, so it is recognised (and spared) when the save folder is cleaned between movies
+        self.output_dir = None if output_dir is None else os.path.abspath(output_dir)
+        self.cpu_profile = self.enabled and cpu_profile
+
+    def reset(self):
+        with self._lock:
+            self._spans = []
+            self._stats = None
+            self._origin = time.perf_counter()
+
+    def record(self, name, start, end, **attrs):
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        span = {
+            'name': name,
+            'thread': thread.name,
+            'tid': thread.ident,
+            'start': start - self._origin,
+            'duration': end - start,
+            'attrs': attrs,
+        }
+        collected = self._collected.get()
+        if collected is not None:
+            # Kept on absolute time until replay() places it in a movie's timeline
+            span['start'] = start
+            collected.append(span)
+            return
+        with self._lock:
+            self._spans.append(span)
+
+    @contextmanager
+    def collect(self):
+        # Spans recorded in this context go to the yielded list instead of the current movie,
+        # the planner resolves movies long before their own timeline starts
+        spans = []
+        token = self._collected.set(spans)
+        try:
+            yield spans
+        finally:
+            self._collected.reset(token)
+
+    def replay(self, spans):
+        # Puts collected spans at the start of the current movie's timeline with their own timing,
+        # the movie's phases follow right after them
+        if not self.enabled or not spans:
+            return
+        first_start = min(x['start'] for x in spans)
+        last_end = max(x['start'] + x['duration'] for x in spans)
+        with self._lock:
+            self._origin = time.perf_counter() - (last_end - first_start)
+            for span in spans:
+                self._spans.append(dict(span, start=span['start'] - first_start, attrs=dict(span['attrs'], planned=True)))
+
+    @contextmanager
+    def span(self, name, **attrs):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), **attrs)
+
+    @contextmanager
+    def cpu_capture(self):
+        # cProfile hooks only the calling thread, so each worker runs its own profiler
+        # and the results are merged into one pstats file per movie.
+        if not self.cpu_profile:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active profiler per interpreter.
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profiler)
+                else:
+                    self._stats.add(profiler)
+
+    def dump(self, movie_name):
+        if not self.enabled:
+            return
+        # A report that cannot be written must not stop the batch
+        try:
+            self._write_reports(movie_name)
+        except OSError as e:
+            logging.error(f"Failed to write the profile of {movie_name}: {e}")
+
+    def _write_reports(self, movie_name):
+        with self._lock:
+            spans = sorted(self._spans, key=lambda x: x['start'])
+            stats = self._stats
+        os.makedirs(self.output_dir, exist_ok=True)
+        base_name = os.path.join(self.output_dir, movie_name)
+
+        timeline = {
+            'movie': movie_name,
+            'total_duration': max((x['start'] + x['duration'] for x in spans), default=0),
+            'spans': spans,
+        }
+        with open(base_name + '.timeline.json', 'w', encoding='utf-8') as file:
+            json.dump(timeline, file, indent=2)
+
+        # Chrome trace event format, open it with chrome://tracing or https://ui.perfetto.dev
+        trace_events = [{
+            'name': x['name'],
+            'cat': 'segment' if x['name'].startswith('segment') else 'phase',
+            'ph': 'X',
+            'ts': round(x['start'] * 1e6, 3),
+            'dur': round(x['duration'] * 1e6, 3),
+            'pid': os.getpid(),
+            'tid': x['tid'],
+            'args': x['attrs'],
+        } for x in spans]
+        thread_names = {x['tid']: x['thread'] for x in spans}
+        for tid, thread_name in thread_names.items():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread_name}})
+        with open(base_name + '.trace.json', 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+
+        if stats is not None:
+            stats.dump_stats(base_name + '.pstats')
+
+        logging.info(f"Profile written: {base_name}.timeline.json, {base_name}.trace.json")
+
+
+tracer = PhaseTracer()
+
+
+def segment_curl_infos():
+    return [curl_cffi.CurlInfo.CONNECT_TIME, curl_cffi.CurlInfo.STARTTRANSFER_TIME, curl_cffi.CurlInfo.TOTAL_TIME]
+
+
+class SegmentCache:
+    # Content-addressed segment store that several processes (or hosts sharing a NAS mount) can use at once.
+    #   blobs/<sha256[:2]>/<sha256>      segment bytes, the file mtime is the LRU clock
+    #   index/<uuid>/<resolution>/<i>    sha256 of the segment stored for that key
+    # Every file is written to a temporary name and moved into place with os.replace,
+    # so a reader sees either nothing or a complete file, and the hash catches anything else.
+    EVICT_LOCK_STALE = 600
+
+    def __init__(self):
+        self.enabled = False
+        self.root = None
+        self.max_bytes = 0
+        self._lock = threading.Lock()
+        self._written = 0
+
+    def configure(self, root, max_bytes):
+        self.enabled = root is not None
+        # Absolute, so it is recognised (and spared) when the save folder is cleaned between movies
+        self.root = None if root is None else os.path.abspath(root)
+        self.max_bytes = max_bytes
+        if self.enabled:
+            os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+            os.makedirs(os.path.join(root, 'index'), exist_ok=True)
+            self.evict()
+
+    def _index_path(self, uuid, resolution, index):
+        return os.path.join(self.root, 'index', uuid, resolution, str(index))
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, uuid, resolution, index):
+        if not self.enabled:
+            return None
+        index_path = self._index_path(uuid, resolution, index)
+        try:
+            with open(index_path, 'r', encoding='ascii') as file:
+                digest = file.read().strip()
+            blob_path = self._blob_path(digest)
+            with open(blob_path, 'rb') as file:
+                content = file.read()
+        except (OSError, ValueError):
+            return None
+
+        if hashlib.sha256(content).hexdigest() != digest:
+            logging.warning(f"Segment cache entry is corrupted, discarding: {blob_path}")
+            for path in (index_path, blob_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return None
+
+        try:
+            os.utime(blob_path)
+        except OSError:
+            pass
+        return content
+
+    def put(self, uuid, resolution, index, content):
+        if not self.enabled:
+            return
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(digest)
+        try:
+            if os.path.exists(blob_path):
+                os.utime(blob_path)
+            else:
+                self._write_atomic(blob_path, content)
+            self._write_atomic(self._index_path(uuid, resolution, index), digest.encode('ascii'))
+        except OSError as e:
+            logging.warning(f"Failed to write segment cache: {e}")
+            return
+
+        # Scanning the cache is not free, so only check the budget after every 5% of it has been written
+        with self._lock:
+            self._written += len(content)
+            should_evict = self._written >= self.max_bytes // 20
+            if should_evict:
+                self._written = 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        # Only one process evicts at a time, the others simply skip this round
+        lock_path = os.path.join(self.root, 'evict.lock')
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > self.EVICT_LOCK_STALE:
+                    # Left behind by a process that died while evicting
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            return
+        except OSError as e:
+            logging.warning(f"Failed to lock segment cache: {e}")
+            return
+        os.close(fd)
+
+        try:
+            blobs = []
+            total_size = 0
+            blobs_root = os.path.join(self.root, 'blobs')
+            for folder in os.scandir(blobs_root):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+            if total_size <= self.max_bytes:
+                return
+
+            # Evict down to 90% of the budget so the next few puts don't trigger another scan
+            target_size = self.max_bytes * 0.9
+            removed_count = 0
+            blobs.sort()
+            for _, size, path in blobs:
+                if total_size <= target_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+                removed_count += 1
+            pruned_count = self._prune_index()
+            logging.info(f"Segment cache evicted {removed_count} segments ({pruned_count} index entries), {total_size} bytes in use.")
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+    def _prune_index(self):
+        # Drops index entries whose blob is gone, whoever evicted it, and the folders they leave empty
+        pruned_count = 0
+        index_root = os.path.join(self.root, 'index')
+        for folder_path, folder_names, file_names in os.walk(index_root, topdown=False):
+            for file_name in file_names:
+                if file_name.endswith('.tmp'):
+                    continue
+                index_path = os.path.join(folder_path, file_name)
+                try:
+                    with open(index_path, 'r', encoding='ascii') as file:
+                        digest = file.read().strip()
+                    if digest and os.path.exists(self._blob_path(digest)):
+                        continue
+                    os.remove(index_path)
+                    pruned_count += 1
+                except (OSError, ValueError):
+                    continue
+            if folder_path != index_root:
+                try:
+                    os.rmdir(folder_path)
+                except OSError:
+                    pass
+        return pruned_count
+
+
+segment_cache = SegmentCache()
+
+
+class ProxyState:
+    def __init__(self, url):
+        self.url = url
+        self.throughput = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.bytes = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.eject_count = 0
+
+
+class ProxyPool:
+    # Spreads segment requests over several proxies, weighted by the throughput measured through each one.
+    # A proxy that keeps failing is ejected for a cool-down period that doubles on every ejection,
+    # then gets trial traffic again: one success puts it back in rotation, one failure ejects it again.
+    # Failures of requests still in flight while the proxy is ejected belong to the same outage and are not held against it.
+    EWMA_ALPHA = 0.2
+    EJECT_CONSECUTIVE_FAILURES = 3
+    EJECT_ERROR_RATE = 0.5
+    EJECT_MIN_REQUESTS = 10
+    EJECT_COOLDOWN = 15
+    EJECT_COOLDOWN_MAX = 300
+    REPIN_REQUESTS = 50
+
+    def __init__(self):
+        self.enabled = False
+        self._proxies = []
+        self._lock = threading.Lock()
+
+    def configure(self, proxy_list):
+        self._proxies = [ProxyState(normalize_proxy_url(x)) for x in dict.fromkeys(proxy_list)]
+        self.enabled = len(self._proxies) > 0
+
+    def lease(self):
+        if not self.enabled:
+            return None
+        return ProxyLease(self)
+
+    def _weight(self, proxy, default_throughput):
+        throughput = default_throughput if proxy.throughput is None else proxy.throughput
+        return max(throughput * (1 - proxy.error_rate), 1.0)
+
+    def choose(self):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [x for x in self._proxies if x.ejected_until <= now]
+            if len(candidates) == 0:
+                # Everything is ejected, keep going through the one that comes back first
+                return min(self._proxies, key=lambda x: x.ejected_until)
+            measured = [x.throughput for x in candidates if x.throughput is not None]
+            # Unmeasured proxies are treated as the best known one so they get measured quickly
+            default_throughput = max(measured) if len(measured) > 0 else 1.0
+            weights = [self._weight(x, default_throughput) for x in candidates]
+            return random.choices(candidates, weights=weights)[0]
+
+    def is_usable(self, proxy):
+        return proxy.ejected_until <= time.monotonic()
+
+    def report_success(self, proxy, size, seconds):
+        with self._lock:
+            throughput = size / max(seconds, 1e-6)
+            if proxy.throughput is None:
+                proxy.throughput = throughput
+            else:
+                proxy.throughput += self.EWMA_ALPHA * (throughput - proxy.throughput)
+            proxy.error_rate -= self.EWMA_ALPHA * proxy.error_rate
+            proxy.requests += 1
+            proxy.bytes += size
+            proxy.consecutive_failures = 0
+            if proxy.eject_count > 0:
+                logging.info(f"Proxy recovered: {proxy.url}")
+                proxy.eject_count = 0
+
+    def report_failure(self, proxy):
+        with self._lock:
+            if proxy.ejected_until > time.monotonic():
+                proxy.requests += 1
+                proxy.failures += 1
+                return
+            proxy.error_rate += self.EWMA_ALPHA * (1 - proxy.error_rate)
+            proxy.requests += 1
+            proxy.failures += 1
+            proxy.consecutive_failures += 1
+            on_trial = proxy.eject_count > 0
+            if (on_trial
+                    or proxy.consecutive_failures >= self.EJECT_CONSECUTIVE_FAILURES
+                    or (proxy.requests >= self.EJECT_MIN_REQUESTS and proxy.error_rate > self.EJECT_ERROR_RATE)):
+                cooldown = min(self.EJECT_COOLDOWN * 2 ** proxy.eject_count, self.EJECT_COOLDOWN_MAX)
+                proxy.ejected_until = time.monotonic() + cooldown
+                proxy.eject_count += 1
+                proxy.consecutive_failures = 0
+                logging.warning(f"Proxy ejected for {cooldown} seconds: {proxy.url} (error rate {proxy.error_rate:.0%})")
+
+    def log_summary(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            for proxy in self._proxies:
+                throughput = 'n/a' if proxy.throughput is None else f"{proxy.throughput / 1024 / 1024:.2f} MB/s"
+                logging.info(f"Proxy {proxy.url}: requests {proxy.requests}, failures {proxy.failures}, "
+                             f"downloaded {proxy.bytes / 1024 / 1024:.1f} MB, throughput {throughput}")
+
+
+class ProxyLease:
+    # Pins one worker thread to one proxy so the curl session (and its connections) is reused.
+    # The worker moves on when its proxy gets ejected, and re-draws every REPIN_REQUESTS requests
+    # so that the pool weights keep shaping the traffic.
+    def __init__(self, pool):
+        self.pool = pool
+        self.proxy = None
+        self._session = None
+        self._requests = 0
+
+    def session(self):
+        if self.proxy is None or not self.pool.is_usable(self.proxy) or self._requests >= self.pool.REPIN_REQUESTS:
+            proxy = self.pool.choose()
+            if proxy is not self.proxy or self._session is None:
+                self.close()
+                self.proxy = proxy
+                curl_infos = segment_curl_infos() if tracer.enabled else None
+                self._session = requests.Session(proxies={'http': proxy.url, 'https': proxy.url}, curl_infos=curl_infos)
+            self._requests = 0
+        self._requests += 1
+        return self._session
+
+    def report_success(self, size, seconds):
+        self.pool.report_success(self.proxy, size, seconds)
+
+    def report_failure(self):
+        self.pool.report_failure(self.proxy)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+proxy_pool = ProxyPool()
+
+
+def normalize_proxy_url(proxy):
+    proxy = proxy.strip()
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return proxy
+
+
+def read_proxy_file(file_path):
+    proxies = []
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                proxies.append(line)
+    return proxies
+
+
+def https_request_with_retry(request_url, retry, delay, timeout, timings=None, proxy_lease=None):
     inner_retry = RETRY
     inner_delay = DELAY
     inner_timeout = TIMEOUT
@@ -99,47 +649,259 @@ def https_request_with_retry(request_url, retry, delay, timeout):
         inner_timeout = int(timeout)
     retries = 0
     while retries < inner_retry:
+        request_start = time.perf_counter()
+        response = None
         try:
-            response = requests.get(url=request_url, headers=headers, timeout=inner_timeout, verify=False).content
-            return response
+            if proxy_lease is not None:
+                response = proxy_lease.session().get(url=request_url, headers=headers, timeout=inner_timeout, verify=False)
+            elif timings is not None:
+                # Same one-shot session as requests.get, but asking curl for its per-phase timers
+                with requests.Session(curl_infos=segment_curl_infos()) as session:
+                    response = session.get(url=request_url, headers=headers, timeout=inner_timeout, verify=False)
+            else:
+                response = requests.get(url=request_url, headers=headers, timeout=inner_timeout, verify=False)
+            # An error page must not end up in the movie (or in the segment cache)
+            response.raise_for_status()
+            content = response.content
         except Exception as e:
             # logging.error(f"Failed to fetch data (attempt {retries + 1}/{max_retries}): {e} url is: {request_url}")
+            # A 404 / 403 comes from the CDN and says nothing about the proxy, only transport errors,
+            # 5xx and proxy authentication failures count against its health
+            if proxy_lease is not None and (response is None or response.status_code >= 500 or response.status_code == 407):
+                proxy_lease.report_failure()
             retries += 1
             time.sleep(inner_delay)
+            continue
+
+        if proxy_lease is not None:
+            proxy_lease.report_success(len(content), time.perf_counter() - request_start)
+        if timings is not None:
+            timings['start'] = request_start
+            timings['attempts'] = retries + 1
+            timings['connect'] = response.infos.get(curl_cffi.CurlInfo.CONNECT_TIME, 0)
+            timings['ttfb'] = response.infos.get(curl_cffi.CurlInfo.STARTTRANSFER_TIME, 0)
+            timings['total'] = response.infos.get(curl_cffi.CurlInfo.TOTAL_TIME, 0)
+        return content
     # logging.error(f"Max retries reached. Failed to fetch data. url is: {request_url}")
     return None
 
 
+def segment_url(uuid, resolution, index):
+    return video_m3u8_prefix + uuid + '/' + resolution + '/' + 'video' + str(index) + '.jpeg'
+
+
 def thread_task(start, end, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout):
+    proxy_lease = proxy_pool.lease()
+    try:
+        if tracer.enabled:
+            with tracer.cpu_capture():
+                traced_thread_task(start, end, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout, proxy_lease)
+        else:
+            untraced_thread_task(start, end, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout, proxy_lease)
+    finally:
+        if proxy_lease is not None:
+            proxy_lease.close()
+
+
+def untraced_thread_task(start, end, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout, proxy_lease):
     for i in range(start, end):
-        url_tmp = 'https://surrit.com/' + uuid + '/' + resolution + '/' + 'video' + str(i) + '.jpeg'
-        content = https_request_with_retry(url_tmp, retry, delay, timeout)
-        if content is None: continue
+        content = segment_cache.get(uuid, resolution, i)
+        if content is None:
+            url_tmp = segment_url(uuid, resolution, i)
+            content = https_request_with_retry(url_tmp, retry, delay, timeout, proxy_lease=proxy_lease)
+            if content is None: continue
+            segment_cache.put(uuid, resolution, i, content)
         file_path = movie_save_path_root + '/' + movie_name + '/video' + str(i) + '.jpeg'
         with open(file_path, 'wb') as file:
             file.write(content)
-        display_progress_bar(video_offset_max + 1, counter)
+        display_progress_bar(video_offset_max + 1, current_counter.get())
+
+
+def traced_thread_task(start, end, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout, proxy_lease):
+    for i in range(start, end):
+        segment_start = time.perf_counter()
+        content = None
+        if segment_cache.enabled:
+            with tracer.span('segment.cache_lookup', index=i):
+                content = segment_cache.get(uuid, resolution, i)
+        file_path = movie_save_path_root + '/' + movie_name + '/video' + str(i) + '.jpeg'
+        if content is not None:
+            with tracer.span('segment.disk_write', index=i):
+                with open(file_path, 'wb') as file:
+                    file.write(content)
+            tracer.record('segment', segment_start, time.perf_counter(), index=i, cached=True, bytes=len(content))
+            display_progress_bar(video_offset_max + 1, current_counter.get())
+            continue
+        url_tmp = segment_url(uuid, resolution, i)
+        timings = {}
+        content = https_request_with_retry(url_tmp, retry, delay, timeout, timings, proxy_lease)
+        if content is None:
+            tracer.record('segment', segment_start, time.perf_counter(), index=i, failed=True)
+            continue
+        request_start = timings['start']
+        connect_end = request_start + timings['connect']
+        ttfb_end = request_start + timings['ttfb']
+        transfer_end = request_start + timings['total']
+        tracer.record('segment.connect', request_start, connect_end, index=i)
+        tracer.record('segment.ttfb', connect_end, ttfb_end, index=i)
+        tracer.record('segment.transfer', ttfb_end, transfer_end, index=i, bytes=len(content))
+        if segment_cache.enabled:
+            with tracer.span('segment.cache_store', index=i):
+                segment_cache.put(uuid, resolution, i, content)
+        with tracer.span('segment.disk_write', index=i):
+            with open(file_path, 'wb') as file:
+                file.write(content)
+        tracer.record('segment', segment_start, time.perf_counter(), index=i, attempts=timings['attempts'], bytes=len(content))
+        display_progress_bar(video_offset_max + 1, current_counter.get())
+
+
+class FileConcatenator:
+    # Appends whole files to an open output file with the cheapest copy the platform offers:
+    # copy_file_range (stays in the kernel, server-side copy on NFS 4.2 / SMB3, reflink on btrfs / xfs),
+    # then sendfile, then readinto a large reused buffer. A method that the file systems involved
+    # do not support is dropped for the rest of the output.
+    UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK}
+
+    def __init__(self, out_fd):
+        self.out_fd = out_fd
+        self.use_copy_file_range = hasattr(os, 'copy_file_range')
+        self.use_sendfile = hasattr(os, 'sendfile')
+        self._buffer = None
+
+    def append(self, in_fd, size):
+        copied = 0
+        if self.use_copy_file_range:
+            try:
+                while copied < size:
+                    count = os.copy_file_range(in_fd, self.out_fd, size - copied)
+                    if count == 0:
+                        return copied
+                    copied += count
+                return copied
+            except OSError as e:
+                if e.errno not in self.UNSUPPORTED_ERRNOS:
+                    raise
+                self.use_copy_file_range = False
+
+        if self.use_sendfile:
+            try:
+                while copied < size:
+                    count = os.sendfile(self.out_fd, in_fd, copied, size - copied)
+                    if count == 0:
+                        return copied
+                    copied += count
+                return copied
+            except OSError as e:
+                if e.errno not in self.UNSUPPORTED_ERRNOS:
+                    raise
+                self.use_sendfile = False
+
+        if self._buffer is None:
+            self._buffer = bytearray(CONCAT_BUFFER_SIZE)
+        view = memoryview(self._buffer)
+        os.lseek(in_fd, copied, os.SEEK_SET)
+        with open(in_fd, 'rb', buffering=0, closefd=False) as infile:
+            while copied < size:
+                count = infile.readinto(view)
+                if not count:
+                    break
+                written = 0
+                while written < count:
+                    written += os.write(self.out_fd, view[written:count])
+                copied += count
+        return copied
+
+
+@cache
+def native_fallocate():
+    # Returns fallocate(fd, size) backed by the file system itself, or None when there is none.
+    # glibc's posix_fallocate is not used on Linux: on file systems without fallocate (NFSv3, ...)
+    # it writes every block of the range, a second full write of the output.
+    if sys.platform.startswith('linux'):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            function = getattr(libc, 'fallocate64', None) or libc.fallocate
+        except (OSError, AttributeError):
+            return None
+        function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+        def linux_fallocate(fd, size):
+            # Mode 0 never emulates, it fails with EOPNOTSUPP instead
+            if function(fd, 0, 0, size) != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+        return linux_fallocate
+    if hasattr(os, 'posix_fallocate'):
+        # The BSDs fail with EINVAL / EOPNOTSUPP rather than emulating
+        return lambda fd, size: os.posix_fallocate(fd, 0, size)
+    return None
+
+
+def preallocate_file(fd, size):
+    # Reserving the space up front avoids fragmentation and fails early when the disk is too small
+    fallocate = native_fallocate()
+    if size <= 0 or fallocate is None:
+        return
+    try:
+        fallocate(fd, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        # The file system has no fallocate, the copy simply goes without preallocation
+
+
+def format_index_ranges(indexes):
+    ranges = []
+    for index in indexes:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ', '.join(str(x) if x == y else f'{x}-{y}' for x, y in ranges)
 
 
 def video_write_jpegs_to_mp4(movie_name, video_offset_max, final_file_name):
     movie_file_name = final_file_name + '.mp4'
     output_file_name = movie_save_path_root + '/' + movie_file_name
     saved_count = 0
+
+    segments = []
+    missing_indexes = []
+    for i in range(video_offset_max + 1):
+        file_path = movie_save_path_root + '/' + movie_name + '/video' + str(i) + '.jpeg'
+        try:
+            segments.append((i, file_path, os.stat(file_path).st_size))
+        except OSError:
+            missing_indexes.append(i)
+    total_size = sum(x[2] for x in segments)
+
+    failed_indexes = []
+    offset = 0
     with open(output_file_name, 'wb') as outfile:
-        for i in range(video_offset_max + 1):
-            file_path = movie_save_path_root + '/' + movie_name + '/video' + str(i) + '.jpeg'
+        out_fd = outfile.fileno()
+        preallocate_file(out_fd, total_size)
+        concatenator = FileConcatenator(out_fd)
+        for i, file_path, size in segments:
             try:
                 with open(file_path, 'rb') as infile:
-                    outfile.write(infile.read())
-                    saved_count = saved_count + 1
-                    print('write: ' + file_path)
-            except FileNotFoundError:
-                print('file not found: ' + file_path)
-                continue
-            except Exception as e:
-                print('exception: ' + str(e))
+                    copied = concatenator.append(infile.fileno(), size)
+            except OSError as e:
+                logging.error(f"Failed to write {file_path}: {e}")
+                copied = -1
+            if copied != size:
+                # Drop whatever part of this segment made it in
+                failed_indexes.append(i)
+                os.lseek(out_fd, offset, os.SEEK_SET)
                 continue
-
+            offset += size
+            saved_count = saved_count + 1
+        # Preallocation (and skipped segments) can leave the file longer than what was written
+        os.ftruncate(out_fd, offset)
+
+    if missing_indexes:
+        logging.warning(f"Missing segments ({len(missing_indexes)}): {format_index_ranges(missing_indexes)}")
+    if failed_indexes:
+        logging.warning(f"Unreadable segments ({len(failed_indexes)}): {format_index_ranges(failed_indexes)}")
     logging.info('Save Completed: ' + output_file_name)
     logging.info(f'Total number of files: {video_offset_max + 1} , number of files saved: {saved_count}')
     logging.info('The file integrity is {:.2%}'.format(saved_count / (video_offset_max + 1)))
@@ -207,12 +969,26 @@ def encoder_selection(encoders, flavors):
                 encoders.insert(index, encoder)
     return encoders if len(encoders) > 0 else ['copy']
 
+@cache
+def ffmpeg_version():
+    # Kept in memory only: running the binary is what proves it works, -ffmpeg and -ffcover share one probe
+    try:
+        output = subprocess.run(['ffmpeg', '-version'], check=True, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.splitlines()[0] if output else ''
+
+@cache
+def ffmpeg_usable_encoders(encoder_type, flavors):
+    # Kept in memory only: hardware encoders depend on the GPU and its driver, not just on the ffmpeg binary
+    encoders = ffmpeg_get_encoders(encoder_type, flavors)
+    return list(ffmpeg_benchmark_encoders(encoders, encoder_type))
+
 @cache
 def ffmpeg_audio_encoder(flavors=("libopus",)):
     encoder_type = 'A'
     flavors = tuple(flavors)
-    encoders = ffmpeg_get_encoders(encoder_type, flavors)
-    usable_encoder = ffmpeg_benchmark_encoders(encoders, encoder_type)
+    usable_encoder = ffmpeg_usable_encoders(encoder_type, flavors)
     usable_encoder = encoder_selection(list(usable_encoder), flavors)
     print(f"Using Audio encoder {usable_encoder[0]}")
     return usable_encoder[0]
@@ -221,22 +997,22 @@ def ffmpeg_audio_encoder(flavors=("libopus",)):
 def ffmpeg_video_encoder(flavors=("hevc", "h264")):
     encoder_type = 'V'
     flavors = tuple(flavors)
-    encoders = ffmpeg_get_encoders(encoder_type, flavors)
-    usable_encoder = ffmpeg_benchmark_encoders(encoders, encoder_type)
+    usable_encoder = ffmpeg_usable_encoders(encoder_type, flavors)
     usable_encoder = encoder_selection(list(usable_encoder), flavors)
     print(f"Using Video encoder {usable_encoder[0]}")
     return usable_encoder[0]
 
-def generate_mp4_by_ffmpeg(movie_name, cover_as_preview, video_reencode, audio_reencode):
-    output_file_name = movie_save_path_root + '/' + movie_name + '.mp4'
+def generate_mp4_by_ffmpeg(movie_name, final_file_name, cover_as_preview, video_reencode, audio_reencode, video_encoder=None, audio_encoder=None):
+    output_file_name = movie_save_path_root + '/' + final_file_name + '.mp4'
     cover_file_name = movie_save_path_root + '/' + movie_name + '-cover.jpg'
     video_parameter = 'copy'
     audio_parameter = 'copy'
 
+    # An explicit encoder skips the automatic selection, the post-processing benchmark compares them this way
     if video_reencode:
-        video_parameter = ffmpeg_video_encoder()
+        video_parameter = video_encoder or ffmpeg_video_encoder()
     if audio_reencode:
-        audio_parameter = ffmpeg_audio_encoder()
+        audio_parameter = audio_encoder or ffmpeg_audio_encoder()
 
     if cover_as_preview and os.path.exists(cover_file_name):
         # ffmpeg -loglevel error -f concat -safe 0 -i ffmpeg_input.txt -i cover.jpg -map 0:v -map 0:a -map 1 -c:v hevc_nvenc -c:a libopus -disposition:v:1 attached_pic -y output.mp4
@@ -246,7 +1022,7 @@ def generate_mp4_by_ffmpeg(movie_name, cover_as_preview, video_reencode, audio_r
             '-progress', 'pipe:1',
             '-f', 'concat',
             '-safe', '0',
-            '-i', FFMPEG_INPUT_FILE,
+            '-i', ffmpeg_input_file(movie_name),
             '-i', cover_file_name,
             '-map', '0:v',
             '-map', '0:a',
@@ -265,7 +1041,7 @@ def generate_mp4_by_ffmpeg(movie_name, cover_as_preview, video_reencode, audio_r
             '-progress', 'pipe:1',
             '-f', 'concat',
             '-safe', '0',
-            '-i', FFMPEG_INPUT_FILE,
+            '-i', ffmpeg_input_file(movie_name),
             '-c:v', video_parameter,
             '-c:a', audio_parameter,
             output_file_name
@@ -314,15 +1090,19 @@ def generate_mp4_by_ffmpeg(movie_name, cover_as_preview, video_reencode, audio_r
         logging.error(f"Movie name: {movie_name}, FFmpeg execution failed: {e}")
         raise e
 
+def ffmpeg_input_file(movie_name):
+    # Kept next to the segments so movies processed side by side don't share one list
+    return movie_save_path_root + '/' + movie_name + '/' + FFMPEG_INPUT_FILE
+
 def generate_input_txt(movie_name, video_offset_max):
-    output_file_name = movie_save_path_root + '/' + movie_name + '.mp4'
     find_count = 0
-    with open(FFMPEG_INPUT_FILE, 'w') as input_txt:
+    with open(ffmpeg_input_file(movie_name), 'w') as input_txt:
         for i in range(video_offset_max + 1):
             file_path = movie_save_path_root + '/' + movie_name + '/video' + str(i) + '.jpeg'
             if os.path.exists(file_path):
                 find_count = find_count + 1
-                input_txt.write(f"file '{file_path}'\n")
+                # The concat demuxer resolves relative paths against the list file's folder
+                input_txt.write(f"file 'video{i}.jpeg'\n")
 
     print()
     total_files = video_offset_max + 1
@@ -332,8 +1112,10 @@ def generate_input_txt(movie_name, video_offset_max):
 
 def video_write_jpegs_to_mp4_by_ffmpeg(movie_name, video_offset_max, cover_as_preview, final_file_name, video_reencode, audio_reencode):
     # make input.txt first
-    generate_input_txt(movie_name, video_offset_max)
-    generate_mp4_by_ffmpeg(movie_name, final_file_name, cover_as_preview, video_reencode, audio_reencode)
+    with tracer.span('generate_input_txt'):
+        generate_input_txt(movie_name, video_offset_max)
+    with tracer.span('ffmpeg'):
+        generate_mp4_by_ffmpeg(movie_name, final_file_name, cover_as_preview, video_reencode, audio_reencode)
 
 def video_download_jpegs(intervals, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout):
     thread_task_list = []
@@ -341,7 +1123,9 @@ def video_download_jpegs(intervals, uuid, resolution, movie_name, video_offset_m
     for interval in intervals:
         start = interval[0]
         end = interval[1]
-        thread = threading.Thread(target=thread_task, args=(start, end, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout))
+        # Run every worker in a copy of this context so it reports to the right progress counter
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(thread_task, start, end, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout))
         thread_task_list.append(thread)
 
     for thread in thread_task_list:
@@ -351,6 +1135,323 @@ def video_download_jpegs(intervals, uuid, resolution, movie_name, video_offset_m
         thread.join()
 
 
+class SegmentCoordinator:
+    # Hands the segments of the current movie out to worker processes (local or on other hosts)
+    # and writes what they send back into the usual <movie>/video<i>.jpeg layout.
+    # Protocol, one JSON object per line:
+    #   worker      -> {"op": "next"}
+    #   coordinator -> {"op": "segment", "job", "uuid", "resolution", "index", "retry", "delay", "timeout"} or {"op": "wait"}
+    #   worker      -> {"op": "result", "job", "index", "size"} followed by size raw bytes,
+    #                  or {"op": "failed", "job", "index"}
+    # Workers build the segment URL themselves from uuid / resolution / index, the coordinator
+    # never makes them fetch an arbitrary URL.
+    # A segment is leased to one connection: only that connection can complete or fail it, and when
+    # the lease runs out (a hung worker) or the connection drops, the segment goes back to the queue.
+    # When no worker has been heard from for WORKER_IDLE_TIMEOUT seconds, threads of this process
+    # join in on the same queue, so a job never waits for workers that are not coming.
+    # There is no authentication, the listener must only be reachable from a trusted network.
+    MAX_ATTEMPTS = 3
+    WORKER_IDLE_TIMEOUT = 30
+    # Idle workers ask for a task every second, a connection silent for longer than this is dead
+    WORKER_SOCKET_TIMEOUT = 60
+    LEASE_MARGIN = 30
+
+    def __init__(self, address):
+        host, port = parse_host_port(address)
+        self._condition = threading.Condition()
+        self._job = None
+        self._job_id = 0
+        self._pending = deque()
+        # index -> (holder, lease deadline)
+        self._in_flight = {}
+        self._attempts = {}
+        self._remaining = 0
+        self._lease_seconds = 0
+        self._last_activity = time.monotonic()
+
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            timeout = SegmentCoordinator.WORKER_SOCKET_TIMEOUT
+
+            def handle(self):
+                coordinator._serve(self.connection, self.rfile, self.wfile)
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server((host, port), Handler)
+        self.address = '{}:{}'.format(*self._server.server_address[:2])
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logging.info("Segment coordinator listening on " + self.address)
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def run_job(self, uuid, resolution, movie_name, video_offset_max, retry, delay, timeout):
+        pending = []
+        for i in range(video_offset_max + 1):
+            content = segment_cache.get(uuid, resolution, i)
+            if content is None:
+                pending.append(i)
+                continue
+            self._write_segment(movie_name, i, content, video_offset_max)
+
+        with self._condition:
+            self._job_id += 1
+            self._job = {
+                'job': self._job_id,
+                'uuid': uuid,
+                'resolution': resolution,
+                'movie_name': movie_name,
+                'video_offset_max': video_offset_max,
+                'retry': retry,
+                'delay': delay,
+                'timeout': timeout,
+            }
+            self._pending = deque(pending)
+            self._in_flight = {}
+            self._attempts = {}
+            self._remaining = len(pending)
+            self._lease_seconds = segment_lease_seconds(retry, delay, timeout) + self.LEASE_MARGIN
+            self._last_activity = time.monotonic()
+            logging.info(f"Waiting for workers to download {len(pending)} segments.")
+            local_workers_started = False
+            while self._remaining > 0:
+                self._condition.wait(timeout=1)
+                self._expire_leases()
+                if not local_workers_started and time.monotonic() - self._last_activity > self.WORKER_IDLE_TIMEOUT:
+                    logging.warning(f"No segment worker active for {self.WORKER_IDLE_TIMEOUT} seconds, downloading the remaining segments locally.")
+                    for _ in range(os.cpu_count()):
+                        threading.Thread(target=self._local_worker, args=(self._job_id,), daemon=True).start()
+                    local_workers_started = True
+            self._job = None
+
+    def _write_segment(self, movie_name, index, content, video_offset_max):
+        file_path = movie_save_path_root + '/' + movie_name + '/video' + str(index) + '.jpeg'
+        with open(file_path, 'wb') as file:
+            file.write(content)
+        display_progress_bar(video_offset_max + 1, counter)
+
+    def _next_task(self, holder):
+        with self._condition:
+            if self._job is None or len(self._pending) == 0:
+                return None
+            index = self._pending.popleft()
+            self._in_flight[index] = (holder, time.monotonic() + self._lease_seconds)
+            task = {'op': 'segment', 'index': index}
+            for key in ('job', 'uuid', 'resolution', 'retry', 'delay', 'timeout'):
+                task[key] = self._job[key]
+            return task
+
+    def _expire_leases(self):
+        # Must be called with the condition held
+        now = time.monotonic()
+        expired = [index for index, (_, deadline) in self._in_flight.items() if deadline < now]
+        for index in expired:
+            logging.warning(f"Segment {index} was not returned within {self._lease_seconds} seconds, handing it out again.")
+            self._fail_locked(self._job['job'], index, self._in_flight[index][0])
+
+    def _local_worker(self, job_id):
+        holder = object()
+        proxy_lease = proxy_pool.lease()
+        try:
+            while True:
+                with self._condition:
+                    if self._job is None or self._job['job'] != job_id:
+                        return
+                task = self._next_task(holder)
+                if task is None:
+                    time.sleep(1)
+                    continue
+                url = segment_url(task['uuid'], task['resolution'], task['index'])
+                content = https_request_with_retry(url, task['retry'], task['delay'], task['timeout'], proxy_lease=proxy_lease)
+                if content is None:
+                    self._fail(task['job'], task['index'], holder)
+                else:
+                    self._complete(task['job'], task['index'], content, holder)
+        finally:
+            if proxy_lease is not None:
+                proxy_lease.close()
+
+    def _take_in_flight(self, job_id, index, holder):
+        # Must be called with the condition held
+        if self._job is None or self._job['job'] != job_id or self._in_flight.get(index, (None,))[0] is not holder:
+            return False
+        del self._in_flight[index]
+        return True
+
+    def _complete(self, job_id, index, content, holder):
+        with self._condition:
+            if not self._take_in_flight(job_id, index, holder):
+                return
+            job = self._job
+        self._write_segment(job['movie_name'], index, content, job['video_offset_max'])
+        segment_cache.put(job['uuid'], job['resolution'], index, content)
+        with self._condition:
+            self._remaining -= 1
+            self._condition.notify_all()
+
+    def _fail(self, job_id, index, holder):
+        with self._condition:
+            self._fail_locked(job_id, index, holder)
+
+    def _fail_locked(self, job_id, index, holder):
+        # Must be called with the condition held
+        if not self._take_in_flight(job_id, index, holder):
+            return
+        self._attempts[index] = self._attempts.get(index, 0) + 1
+        if self._attempts[index] < self.MAX_ATTEMPTS:
+            self._pending.append(index)
+        else:
+            # Same as thread_task: give up on the segment and let the writer report it missing
+            self._remaining -= 1
+            self._condition.notify_all()
+
+    def _requeue(self, job_id, index, holder):
+        with self._condition:
+            if self._take_in_flight(job_id, index, holder):
+                self._pending.appendleft(index)
+
+    def _serve(self, connection, rfile, wfile):
+        # Each connection leases segments under its own holder, results for segments leased to
+        # another connection (or already handed out again) are dropped
+        holder = object()
+        held = set()
+        try:
+            for line in rfile:
+                self._last_activity = time.monotonic()
+                message = json.loads(line)
+                op = message.get('op')
+                if op == 'next':
+                    task = self._next_task(holder)
+                    if task is None:
+                        task = {'op': 'wait'}
+                        connection.settimeout(self.WORKER_SOCKET_TIMEOUT)
+                    else:
+                        held.add((task['job'], task['index']))
+                        # The worker stays silent while it downloads, for as long as its lease
+                        connection.settimeout(max(self.WORKER_SOCKET_TIMEOUT, self._lease_seconds))
+                    wfile.write(json.dumps(task).encode('utf-8') + b'\n')
+                    wfile.flush()
+                elif op == 'result':
+                    size = int(message['size'])
+                    if size > MAX_SEGMENT_SIZE:
+                        break
+                    content = rfile.read(size)
+                    if len(content) != size:
+                        break
+                    held.discard((message['job'], message['index']))
+                    self._complete(message['job'], message['index'], content, holder)
+                elif op == 'failed':
+                    held.discard((message['job'], message['index']))
+                    self._fail(message['job'], message['index'], holder)
+                else:
+                    break
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Segment worker connection error: {e}")
+        finally:
+            for job_id, index in held:
+                self._requeue(job_id, index, holder)
+
+
+segment_coordinator = None
+
+
+def segment_lease_seconds(retry, delay, timeout):
+    # Worst case of https_request_with_retry for one segment
+    inner_retry = RETRY if retry is None else int(retry)
+    inner_delay = DELAY if delay is None else int(delay)
+    inner_timeout = TIMEOUT if timeout is None else int(timeout)
+    return inner_retry * (inner_timeout + inner_delay)
+
+
+def check_segment_task(task):
+    # The segment URL is built from these, they must stay inside the CDN path
+    return (isinstance(task.get('index'), int) and task['index'] >= 0
+            and isinstance(task.get('uuid'), str) and re.fullmatch(r'[0-9A-Za-z-]+', task['uuid']) is not None
+            and isinstance(task.get('resolution'), str) and re.fullmatch(r'\w[\w.-]*', task['resolution']) is not None)
+
+
+def parse_host_port(address):
+    host, _, port = address.rpartition(':')
+    if host == '' or not port.isdigit():
+        raise ValueError(f"Invalid address, expected HOST:PORT: {address}")
+    return host.strip('[]'), int(port)
+
+
+def segment_worker_loop(host, port):
+    proxy_lease = proxy_pool.lease()
+    while True:
+        try:
+            with socket.create_connection((host, port)) as sock:
+                rfile = sock.makefile('rb')
+                wfile = sock.makefile('wb')
+                while True:
+                    wfile.write(b'{"op": "next"}\n')
+                    wfile.flush()
+                    line = rfile.readline()
+                    if not line:
+                        break
+                    task = json.loads(line)
+                    if task['op'] != 'segment':
+                        time.sleep(1)
+                        continue
+                    if not check_segment_task(task):
+                        logging.error(f"Coordinator {host}:{port} sent an invalid segment task, disconnecting.")
+                        break
+                    uuid = task['uuid']
+                    resolution = task['resolution']
+                    index = task['index']
+                    content = segment_cache.get(uuid, resolution, index)
+                    if content is None:
+                        url = segment_url(uuid, resolution, index)
+                        content = https_request_with_retry(url, task['retry'], task['delay'], task['timeout'], proxy_lease=proxy_lease)
+                        if content is not None:
+                            segment_cache.put(uuid, resolution, index, content)
+                    if content is None:
+                        reply = {'op': 'failed', 'job': task['job'], 'index': index}
+                        wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                    else:
+                        reply = {'op': 'result', 'job': task['job'], 'index': index, 'size': len(content)}
+                        wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                        wfile.write(content)
+                    wfile.flush()
+        except (OSError, ValueError) as e:
+            logging.info(f"Coordinator {host}:{port} is not available ({e}), retrying in {DELAY} seconds.")
+        time.sleep(DELAY)
+
+
+def run_segment_worker(args):
+    configure_segment_sources(args)
+    host, port = parse_host_port(args.worker)
+    num_threads = os.cpu_count()
+    logging.info(f"Segment worker started with {num_threads} threads, coordinator: {host}:{port}")
+    worker_threads = [threading.Thread(target=segment_worker_loop, args=(host, port)) for _ in range(num_threads)]
+    for thread in worker_threads:
+        thread.start()
+    for thread in worker_threads:
+        thread.join()
+
+
+def spawn_local_workers(address, count, args):
+    host, port = parse_host_port(address)
+    if host in ('0.0.0.0', '::'):
+        host = '127.0.0.1'
+    command = [sys.executable, os.path.abspath(__file__), '-worker', f'{host}:{port}']
+    # Local workers share this process's proxy settings, the cache is already checked by the coordinator
+    if args.proxy is not None:
+        command += ['-proxy', args.proxy]
+    if args.proxy_pool is not None:
+        command += ['-proxy-pool'] + args.proxy_pool
+    if args.proxy_file is not None:
+        command += ['-proxy-file', args.proxy_file]
+    logging.info(f"Starting {count} local segment workers.")
+    return [subprocess.Popen(command) for _ in range(count)]
+
+
 def split_integer_into_intervals(integer, n):
     interval_size = integer // n
     remainder = integer % n
@@ -368,37 +1469,94 @@ def create_root_folder_if_not_exists(folder_name):
         os.makedirs(path)
 
 
-def get_movie_uuid(url):
-    html = requests.get(url=url, headers=headers, verify=False).text
+class MovieMetadata:
+    # What miyuki reads from a movie page. tags holds the lower-cased links of the
+    # genre / actress / maker section, the way -tags matches them.
+    __slots__ = ('uuid', 'title', 'tags', 'cover', 'actresses', 'duration')
 
-    with open(TMP_THML_FILE, "w", encoding="UTF-8") as file:
-        file.write(html)
+    def __init__(self):
+        self.uuid = None
+        self.title = None
+        self.tags = []
+        self.cover = None
+        self.actresses = []
+        self.duration = None
+
+
+class MetadataExtractor:
+    # Scans the movie page once, chunk by chunk while it is still downloading.
+    # A match that reaches the end of a chunk may still grow, so it is only taken once more
+    # text follows it, the last METADATA_MATCH_SPAN characters are carried over to the next chunk.
+    def __init__(self):
+        self.metadata = MovieMetadata()
+        self._buffer = ''
+
+    def feed(self, text):
+        self._buffer += text
+        self._scan(final=False)
+
+    def close(self):
+        self._scan(final=True)
+        self._buffer = ''
+        return self.metadata
+
+    def _scan(self, final):
+        buffer = self._buffer
+        consumed = 0
+        for found in match_movie_metadata.finditer(buffer):
+            if not final and found.end() == len(buffer):
+                break
+            self._collect(found)
+            consumed = found.end()
+        self._buffer = buffer[max(consumed, len(buffer) - METADATA_MATCH_SPAN):]
+
+    def _collect(self, found):
+        metadata = self.metadata
+        kind = found.lastgroup
+        # The first occurrence wins for single values, like re.search did
+        if kind == 'uuid':
+            if metadata.uuid is None:
+                metadata.uuid = "-".join(found.group('uuid').split("|")[::-1])
+        elif kind == 'title':
+            if metadata.title is None:
+                metadata.title = found.group('title').strip().replace("&#039;", "'")
+        elif kind == 'cover':
+            if metadata.cover is None:
+                metadata.cover = found.group('cover')
+        elif kind == 'duration':
+            if metadata.duration is None:
+                metadata.duration = int(found.group('duration'))
+        else:
+            link = found.group('link').lower()
+            metadata.tags.append(link)
+            if '/actresses/' in link:
+                metadata.actresses.append(found.group('link_text').strip())
 
-    match = re.search(match_uuid_pattern, html)
 
-    if match:
-        result = match.group(1)
-        resule_str_list = result.split("|")
-        uuid = "-".join(resule_str_list[::-1])
-        logging.info("Matching uuid successfully: " + uuid)
-        return uuid, html
+def get_movie_metadata(url):
+    extractor = MetadataExtractor()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    response = requests.get(url=url, headers=headers, verify=False, stream=True)
+    try:
+        for chunk in response.iter_content():
+            extractor.feed(decoder.decode(chunk))
+        extractor.feed(decoder.decode(b'', final=True))
+    finally:
+        response.close()
+    metadata = extractor.close()
+
+    if metadata.uuid is not None:
+        logging.info("Matching uuid successfully: " + metadata.uuid)
     else:
         logging.error("Failed to match uuid.")
+    return metadata
 
-def get_movie_title(movie_html, movie_name):
 
-    match = re.search(match_title_pattern, movie_html)
-
-    if match:
-        result = match.group(1)
-        result = result.replace("&#039;", "'")
-        # if "uncensored-leak" in movie_name:
-        #     result += "[Uncensored]"
-        result = result.replace('/', '_')
-        result = result.replace('\\', '_')
-        return result
-
-    return None
+def get_movie_title(metadata):
+    if metadata.title is None:
+        return None
+    # The title becomes the file name with -title
+    return metadata.title.replace('/', '_').replace('\\', '_')
 
 def write_error_to_text_file(url, e):
     with open(ERROR_RECORD_FILE, "a", encoding="UTF-8") as file:
@@ -422,14 +1580,20 @@ def find_last_non_empty_line(text):
             return line
     raise Exception("Failed to find the last non-empty line in m3u8 playlist.")
 
+downloaded_urls_mtime = None
+
 def already_downloaded(url):
+    global downloaded_urls_mtime
     if os.path.exists(RECORD_FILE):
-        with open(RECORD_FILE, 'r', encoding='utf-8') as file:
-            for line in file:
-                downloaded_urls.add(line.strip())
+        # Only re-read the history when it changed, long batches and the service ask for every movie
+        mtime = os.stat(RECORD_FILE).st_mtime_ns
+        if mtime != downloaded_urls_mtime:
+            with open(RECORD_FILE, 'r', encoding='utf-8') as file:
+                for line in file:
+                    downloaded_urls.add(line.strip())
+            downloaded_urls_mtime = mtime
     return url in downloaded_urls
 
-=======
 
 def find_closest(arr, target):
 
@@ -472,34 +1636,51 @@ def get_final_quality_and_resolution(playlist, quality : str):
         final_quality = resolution_url.split('/')[0]
         return final_quality, resolution_url
 
-def download(movie_url, download_action=True, write_action=True, ffmpeg_action=False,
-             num_threads=os.cpu_count(), cover_action=True, title_action=False, cover_as_preview=False,
-             video_reencode=False, audio_reencode=False, quality=None , retry=None, delay=None, timeout=None):
-
-    movie_name = movie_url.split('/')[-1]
-
-    if already_downloaded(movie_url):
-        logging.info(movie_name + " already exists, skip downloading.")
-        return
-
-    movie_uuid, movie_html = get_movie_uuid(movie_url)
-    if movie_uuid is None:
-        return
-
-    playlist_url = video_m3u8_prefix + movie_uuid + video_playlist_suffix
+class MoviePlan:
+    # What is known about a movie before its segments are downloaded, filled by resolve_movie
+    # and, for batches, completed with size estimates by the planner
+    def __init__(self, movie_url, metadata=None):
+        self.movie_url = movie_url
+        self.movie_name = movie_url.split('/')[-1]
+        # Set up front when a search already fetched the movie page
+        self.metadata = metadata
+        self.final_quality = None
+        self.resolution = None
+        self.video_offset_max = None
+        self.duration = 0.0
+        self.estimated_bytes = None
+        self.trace_spans = []
+
+    @property
+    def movie_uuid(self):
+        return None if self.metadata is None else self.metadata.uuid
+
+    @property
+    def final_file_name(self):
+        return self.movie_name + '_' + self.final_quality
+
+
+def resolve_movie(movie_plan, quality):
+    if movie_plan.metadata is None:
+        with tracer.span('get_movie_metadata', url=movie_plan.movie_url):
+            movie_plan.metadata = get_movie_metadata(movie_plan.movie_url)
+    if movie_plan.metadata.uuid is None:
+        return False
 
-    playlist = requests.get(url=playlist_url, headers=headers, verify=False).text
+    playlist_url = video_m3u8_prefix + movie_plan.movie_uuid + video_playlist_suffix
 
-    final_quality, resolution_url = get_final_quality_and_resolution(playlist, quality)
+    with tracer.span('playlist', url=playlist_url):
+        playlist = requests.get(url=playlist_url, headers=headers, verify=False).text
 
-    final_file_name = movie_name + '_' + final_quality
+    movie_plan.final_quality, resolution_url = get_final_quality_and_resolution(playlist, quality)
 
-    resolution = resolution_url.split('/')[0]
+    movie_plan.resolution = resolution_url.split('/')[0]
 
-    video_m3u8_url = video_m3u8_prefix + movie_uuid + '/' + resolution_url
+    video_m3u8_url = video_m3u8_prefix + movie_plan.movie_uuid + '/' + resolution_url
 
     # video.m3u8 records all jpeg video units of the video
-    video_m3u8 = requests.get(url=video_m3u8_url, headers=headers, verify=False).text
+    with tracer.span('video_m3u8', url=video_m3u8_url):
+        video_m3u8 = requests.get(url=video_m3u8_url, headers=headers, verify=False).text
 
     # In the penultimate line of video.m3u8, find the maximum jpeg video unit number of the video
     video_offset_max_str = video_m3u8.splitlines()[-2]
@@ -512,48 +1693,94 @@ def download(movie_url, download_action=True, write_action=True, ffmpeg_action=F
     # #EXTINF:2.250000,
     # video1775.jpeg
     # #EXT-X-ENDLIST
-    video_offset_max = int(re.search(r'(\d+)', video_offset_max_str).group(0))
+    movie_plan.video_offset_max = int(re.search(r'(\d+)', video_offset_max_str).group(0))
+    movie_plan.duration = sum(float(x) for x in re.findall(r'#EXTINF:([\d.]+)', video_m3u8))
+    return True
+
+
+def download(movie_url, download_action=True, write_action=True, ffmpeg_action=False,
+             num_threads=os.cpu_count(), cover_action=True, title_action=False, cover_as_preview=False,
+             video_reencode=False, audio_reencode=False, quality=None , retry=None, delay=None, timeout=None,
+             movie_plan=None):
+
+    movie_name = movie_url.split('/')[-1]
+
+    if already_downloaded(movie_url):
+        logging.info(movie_name + " already exists, skip downloading.")
+        return
+
+    # The batch planner already resolved the movie, a single download resolves it here
+    if movie_plan is None:
+        movie_plan = MoviePlan(movie_url)
+    if movie_plan.video_offset_max is None:
+        if not resolve_movie(movie_plan, quality):
+            # Callers (sync checkpoints, service jobs) must not take this for a finished download
+            raise Exception("Failed to match the movie uuid.")
+
+    movie_uuid = movie_plan.movie_uuid
+    final_file_name = movie_plan.final_file_name
+    resolution = movie_plan.resolution
+    video_offset_max = movie_plan.video_offset_max
 
     create_root_folder_if_not_exists(movie_name)
 
     intervals = split_integer_into_intervals(video_offset_max + 1, num_threads)
 
-    movie_title = get_movie_title(movie_html, movie_name)
+    movie_title = get_movie_title(movie_plan.metadata)
 
     if cover_action:
         try:
-            cover_pic_url = f"{COVER_URL_PREFIX}{movie_name}/cover-n.jpg"
-            cover_pic = requests.get(url=cover_pic_url, headers=headers, verify=False).content
-            with open(movie_save_path_root + '/' + movie_name + '-cover.jpg', 'wb') as file:
-                file.write(cover_pic)
+            # Older pages have no og:image, their cover sits at a predictable address
+            cover_pic_url = movie_plan.metadata.cover or f"{COVER_URL_PREFIX}{movie_name}/cover-n.jpg"
+            with tracer.span('cover', url=cover_pic_url):
+                cover_pic = requests.get(url=cover_pic_url, headers=headers, verify=False).content
+                with open(movie_save_path_root + '/' + movie_name + '-cover.jpg', 'wb') as file:
+                    file.write(cover_pic)
         except Exception as e:
             logging.error(f"Movie name : {movie_name}, failed to download the cover: {e}")
 
     if download_action:
-        counter.reset()
-        video_download_jpegs(intervals, movie_uuid, resolution, movie_name, video_offset_max, retry, delay, timeout)
-        counter.reset()
+        current_counter.get().reset()
+        if segment_coordinator is not None:
+            with tracer.span('segments', count=video_offset_max + 1, distributed=True):
+                segment_coordinator.run_job(movie_uuid, resolution, movie_name, video_offset_max, retry, delay, timeout)
+        else:
+            with tracer.span('segments', count=video_offset_max + 1, threads=len(intervals)):
+                video_download_jpegs(intervals, movie_uuid, resolution, movie_name, video_offset_max, retry, delay, timeout)
+        current_counter.get().reset()
 
     if write_action:
         if ffmpeg_action:
             video_write_jpegs_to_mp4_by_ffmpeg(movie_name, video_offset_max, cover_as_preview, final_file_name, video_reencode, audio_reencode)
         else:
-            video_write_jpegs_to_mp4(movie_name, video_offset_max, final_file_name)
+            with tracer.span('concat'):
+                video_write_jpegs_to_mp4(movie_name, video_offset_max, final_file_name)
 
     with open(RECORD_FILE, 'a', encoding='utf-8') as file:
         file.write(movie_url + '\n')
 
     if movie_title is not None and title_action:
-        os.rename(f"{movie_save_path_root}/{final_file_name}.mp4", f"{movie_save_path_root}/{movie_title}.mp4")
+        with tracer.span('rename'):
+            os.rename(f"{movie_save_path_root}/{final_file_name}.mp4", f"{movie_save_path_root}/{movie_title}.mp4")
+
 
+def protected_folders():
+    # Folders of other features that may sit inside the save folder and must outlive each movie
+    return [x for x in [tracer.output_dir, segment_cache.root] if x is not None]
 
-def delete_all_subfolders(folder_path):
+
+def delete_all_subfolders(folder_path, keep_paths=()):
     if not os.path.exists(folder_path):
         return
+    keep_paths = [os.path.realpath(x) for x in keep_paths]
     for item in os.listdir(folder_path):
         item_path = os.path.join(folder_path, item)
-        if os.path.isdir(item_path):
-            shutil.rmtree(item_path)
+        if not os.path.isdir(item_path):
+            continue
+        real_path = os.path.realpath(item_path)
+        if any(x == real_path or x.startswith(real_path + os.sep) for x in keep_paths):
+            continue
+        shutil.rmtree(item_path)
 
 
 def check_single_non_none(param1, param2, param3, param4, param5):
@@ -563,11 +1790,7 @@ def check_single_non_none(param1, param2, param3, param4, param5):
 
 def check_ffmpeg_command(ffmpeg):
     if ffmpeg:
-        try:
-            subprocess.run(['ffmpeg', '-version'], check=True, stdout=subprocess.DEVNULL)
-            return True
-        except subprocess.CalledProcessError as e:
-            return False
+        return ffmpeg_version() is not None
     else:
         return True
 
@@ -596,6 +1819,17 @@ def check_file(file_path):
 
     return os.path.getsize(file_path) > 0
 
+def check_address(address):
+    if address is None:
+        return True
+
+    try:
+        parse_host_port(address)
+    except ValueError:
+        return False
+
+    return True
+
 def check_positive_integer(limit):
     if limit is None:
         return True
@@ -618,6 +1852,18 @@ def validate_args(args):
     retry = args.retry
     delay = args.delay
     timeout = args.timeout
+    profile = args.profile
+    profile_cpu = args.profile_cpu
+    cache = args.cache
+    cache_size = args.cache_size
+    proxy_file = args.proxy_file
+    sync = args.sync
+    coordinator = args.coordinator
+    local_workers = args.local_workers
+    serve = args.serve
+    concurrency = args.concurrency
+    order = args.order
+    noplan = args.noplan
 
     if not check_ffmpeg_command(ffmpeg):
         logging.error("FFmpeg command status error.")
@@ -627,8 +1873,19 @@ def validate_args(args):
         logging.error("FFmpeg command status error.")
         exit(magic_number)
 
-    if not check_single_non_none(urls, auth, plist, search, file):
-        logging.error("Among -urls, -auth, -search, -plist, and -file, exactly one option must be specified.")
+    if serve is not None:
+        if not check_address(serve):
+            logging.error("The -serve option accepts only HOST:PORT.")
+            exit(magic_number)
+        if any(x is not None for x in [urls, auth, plist, search, file, coordinator, local_workers, args.profile]):
+            logging.error("The -serve option takes its movies from the API, it cannot be combined with -urls, -auth, -plist, -search, -file, -coordinator, -local-workers or -profile.")
+            exit(magic_number)
+    elif not check_single_non_none(urls, auth, plist, search, file):
+        logging.error("Among -urls, -auth, -search, -plist, -file and -serve, exactly one option must be specified.")
+        exit(magic_number)
+
+    if not check_positive_integer(concurrency):
+        logging.error("The -concurrency option accepts only positive integers.")
         exit(magic_number)
 
     if not check_auth(auth):
@@ -660,95 +1917,444 @@ def validate_args(args):
         logging.error("The -timeout option accepts only positive integers.")
         exit(magic_number)
 
-def loop_fill_movie_urls_by_page(playlist_url, movie_url_list, limit, cookie):
+    if order is not None and order not in ORDER_POLICIES:
+        logging.error("The -order option accepts only " + ", ".join(ORDER_POLICIES) + ".")
+        exit(magic_number)
+
+    if order == 'tags' and not args.tags.strip():
+        logging.error("The -order tags option requires the -tags option.")
+        exit(magic_number)
+
+    if noplan and order not in (None, 'listing'):
+        logging.error("The -order option needs the planning stage, it cannot be combined with -noplan.")
+        exit(magic_number)
+
+    if sync and plist is None and auth is None:
+        logging.error("The -sync option only works with the -plist or -auth option.")
+        exit(magic_number)
+
+    if not check_address(coordinator):
+        logging.error("The -coordinator option accepts only HOST:PORT.")
+        exit(magic_number)
+
+    if not check_positive_integer(local_workers):
+        logging.error("The -local-workers option accepts only positive integers.")
+        exit(magic_number)
+
+    if not check_file(proxy_file):
+        logging.error("The -proxy-file option accepts only a valid file path.")
+        exit(magic_number)
+
+    if not check_positive_integer(cache_size):
+        logging.error("The -cache-size option accepts only positive integers.")
+        exit(magic_number)
+
+    if cache is not None and os.path.exists(cache) and not os.path.isdir(cache):
+        logging.error("The -cache option accepts only a directory path.")
+        exit(magic_number)
+
+    if profile_cpu and profile is None:
+        logging.error("The -profile-cpu option requires the -profile option.")
+        exit(magic_number)
+
+    if profile is not None and os.path.exists(profile) and not os.path.isdir(profile):
+        logging.error("The -profile option accepts only a directory path.")
+        exit(magic_number)
+
+def loop_fill_movie_urls_by_page(playlist_url, movie_url_list, limit, cookie, known_urls=None):
     while playlist_url:
         html_source = requests.get(url=playlist_url, headers=headers, verify=False, cookies=cookie).text
         movie_url_matches = re.findall(pattern=href_regex_public_playlist, string=html_source)
-        temp_url_list = list(set(movie_url_matches))
+        # Keep the page order, the incremental sync relies on the listing's sort order
+        temp_url_list = list(dict.fromkeys(movie_url_matches))
+        reached_known = False
         for movie_url in temp_url_list:
+            if known_urls is not None and movie_url in known_urls:
+                reached_known = True
+                continue
             movie_url_list.append(movie_url)
             logging.info(f"Movie {len(movie_url_list)} url: {movie_url}")
             if limit is not None and len(movie_url_list) >= int(limit):
                 return
+        if reached_known:
+            # Everything beyond this page was already seen by a previous sync
+            logging.info("Reached movies seen by the last sync, stop paginating.")
+            return
         next_page_matches = re.findall(pattern=href_regex_next_page, string=html_source)
         if len(next_page_matches) == 1:
             playlist_url = next_page_matches[0].replace('&amp;', '&')
         else:
             break
 
-def get_public_playlist(playlist_url, limit):
+def get_public_playlist(playlist_url, limit, known_urls=None):
     movie_url_list = []
     logging.info("Getting the URLs of all movies.")
-    loop_fill_movie_urls_by_page(playlist_url=playlist_url, movie_url_list=movie_url_list, limit=limit, cookie=None)
+    loop_fill_movie_urls_by_page(playlist_url=playlist_url, movie_url_list=movie_url_list, limit=limit, cookie=None, known_urls=known_urls)
     logging.info("All the video URLs have been successfully obtained.")
     return movie_url_list
 
 
-def get_movie_collections(cookie):
+def get_movie_collections(cookie, known_urls=None):
     movie_url_list = []
     url = 'https://missav.ai/saved'
-    loop_fill_movie_urls_by_page(playlist_url=url, movie_url_list=movie_url_list, limit=None, cookie=cookie)
+    loop_fill_movie_urls_by_page(playlist_url=url, movie_url_list=movie_url_list, limit=None, cookie=cookie, known_urls=known_urls)
     logging.info("All the video URLs have been successfully obtained.")
     return movie_url_list
 
+
+def load_sync_state():
+    if not os.path.exists(SYNC_STATE_FILE):
+        return {}
+    try:
+        with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (ValueError, OSError) as e:
+        logging.error(f"Failed to read {SYNC_STATE_FILE}, starting a full sync: {e}")
+        return {}
+
+
+def save_sync_state(state):
+    # Write then rename, an interrupted run must never leave a truncated checkpoint behind
+    tmp_file = SYNC_STATE_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=2)
+    os.replace(tmp_file, SYNC_STATE_FILE)
+
+
+def get_sync_known_urls(state, listing_key):
+    listing = state.get(listing_key)
+    if listing is None:
+        logging.info("No checkpoint for this listing yet, running a full sync: " + listing_key)
+        return set()
+    logging.info(f"Incremental sync from checkpoint of {listing['updated']} ({len(listing['seen'])} known movies): {listing_key}")
+    return set(listing['seen'])
+
+
+# The seen set only grows once a run got through its whole list, so a run killed halfway crawls the
+# same movies again next time. Until then the crawl is kept as pending, and whatever is still pending
+# at the end (failed, or dropped by the planner) is offered again however early the next crawl stops.
+def start_sync_run(state, listing_key, movie_urls):
+    listing = state.setdefault(listing_key, {'seen': [], 'pending': [], 'updated': None})
+    pending = listing.get('pending', [])
+    if pending:
+        logging.info(f"Retrying {len(pending)} movies left over by the last sync.")
+    listing['pending'] = dedupe_movie_urls(movie_urls + pending)
+    listing['updated'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    save_sync_state(state)
+    return list(listing['pending'])
+
+
+def checkpoint_sync_url(state, listing_key, movie_url):
+    listing = state[listing_key]
+    if movie_url in listing['pending']:
+        listing['pending'].remove(movie_url)
+    listing['updated'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    save_sync_state(state)
+
+
+def finish_sync_run(state, listing_key, crawled_urls):
+    listing = state[listing_key]
+    known_urls = set(listing['seen'])
+    listing['seen'].extend(x for x in crawled_urls if x not in known_urls)
+    listing['updated'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    save_sync_state(state)
+
 def order_url_by_tags_match(urls, filter_tags, strict=False):
     #TODO: Implement strict
     #TODO: Implement in other functions ()
+    # Returns (url, metadata) pairs, the download reuses the metadata instead of fetching the page again
     f_urls = [None for _ in range(len(urls))]
     for url in urls:
         score = 0
-        html = requests.get(url=url, headers=headers).text.lower()
-        allgenre = re.findall(pattern=match_tags_section, string=html)
-
-        # Plain and Stupid : just check in tag in html page
-        # TODO: use of bs4 might be helpful
+        metadata = get_movie_metadata(url)
+        allgenre = metadata.tags
 
         for tag in filter_tags:
             score += int(any([tag in genre for genre in allgenre]))
-        f_urls.insert(len(filter_tags) - score, url)
+        f_urls.insert(len(filter_tags) - score, (url, metadata))
 
     if not strict:
         f_urls = list(filter(None, f_urls))
     return f_urls
 
 def get_movie_url_by_search(key, filter_tags):
+    # Returns (url, metadata), metadata is None unless the tags matching had to fetch the movie pages
     key = key.lower()
     search_url = "https://missav.com/search/" + key
-    search_regex = r'<a href="([^"]+)" alt="' + key + r'([\-a-z]*)" >'
+    search_regex = r'<a href="([^"]+)" alt="' + re.escape(key) + r'([\-a-z]*)" >'
     html_source = requests.get(url=search_url, headers=headers, verify=False).text
     movie_url_matches = re.findall(pattern=search_regex, string=html_source)
-    temp_url_list = list(map(lambda x:x[0], set(movie_url_matches)))
+    temp_url_list = list(map(lambda x:(x[0], None), set(movie_url_matches)))
 
     if len(filter_tags) > 0 and len(temp_url_list) > 1:
         print("Looking for best maching url with matching tags")
-        temp_url_list = order_url_by_tags_match(temp_url_list, filter_tags)
+        temp_url_list = order_url_by_tags_match([x[0] for x in temp_url_list], filter_tags)
     if (len(temp_url_list) != 0):
         return temp_url_list[0]
     else:
-        return None
+        return None, None
 
-def get_urls_from_file(file, filter_tags):
+def get_urls_from_file(file, filter_tags, movie_metadata=None):
+    # Metadata fetched by the searches goes into movie_metadata (url -> MovieMetadata) when given
     urls = []
     with open(file, 'r', encoding='utf-8') as file:
         for url in file.readlines():
             url = url.strip()
             if re.search(r'^[a-z]+\-[0-9]+$',  url.lower()):
                 key = url.lower()
-                url = get_movie_url_by_search(key, filter_tags)
+                url, metadata = get_movie_url_by_search(key, filter_tags)
                 if url is None:
                     continue
                 print(f"Found url {url} for {key}")
+                if metadata is not None and movie_metadata is not None:
+                    movie_metadata[url] = metadata
             urls.append(url)
     return urls
 
+def normalize_movie_id(url):
+    # https://missav.ai/sw-950, https://missav.ai/en/SW-950/ and .../sw-950?ref=home are one movie
+    path = urllib.parse.urlsplit(url.strip()).path
+    return path.rstrip('/').split('/')[-1].lower()
+
+
+def dedupe_movie_urls(movie_urls):
+    unique_urls = {}
+    for url in movie_urls:
+        unique_urls.setdefault(normalize_movie_id(url), url)
+    if len(unique_urls) < len(movie_urls):
+        logging.info(f"Dropped {len(movie_urls) - len(unique_urls)} duplicate movies.")
+    return list(unique_urls.values())
+
+
+def format_bytes(size):
+    if size is None:
+        return 'n/a'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'n/a'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def probe_segment_size(url, timeout):
+    # HEAD first, then a one byte range request for servers that leave out Content-Length
+    try:
+        response = requests.head(url=url, headers=headers, timeout=timeout, verify=False)
+        content_length = response.headers.get('Content-Length')
+        if response.status_code == 200 and content_length:
+            return int(content_length)
+        response = requests.get(url=url, headers={**headers, 'Range': 'bytes=0-0'}, timeout=timeout, verify=False)
+        total_size = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+        if response.status_code == 206 and total_size.isdigit():
+            return int(total_size)
+        if response.status_code == 200:
+            # The range was ignored and the whole segment came back
+            return len(response.content)
+    except Exception as e:
+        logging.debug(f"Failed to probe the segment size of {url}: {e}")
+    return None
+
+
+def estimate_movie_size(movie_plan, timeout, measure_throughput):
+    # Extrapolates the size from a few evenly spaced segments. With measure_throughput the first
+    # sample is downloaded whole to time it, only worth it when the segment cache keeps it for the
+    # download, otherwise the planner does it for a single movie of the batch.
+    # Returns (bytes, seconds) of that transfer, or None.
+    segment_count = movie_plan.video_offset_max + 1
+    indexes = sorted({segment_count * i // SIZE_PROBE_SAMPLES for i in range(SIZE_PROBE_SAMPLES)})
+    sizes = []
+    transfer = None
+    for index in indexes:
+        cached = segment_cache.get(movie_plan.movie_uuid, movie_plan.resolution, index)
+        if cached is not None:
+            sizes.append(len(cached))
+            continue
+        if measure_throughput and transfer is None:
+            start = time.perf_counter()
+            content = https_request_with_retry(segment_url(movie_plan.movie_uuid, movie_plan.resolution, index), 1, 0, timeout)
+            if content is not None:
+                transfer = (len(content), time.perf_counter() - start)
+                segment_cache.put(movie_plan.movie_uuid, movie_plan.resolution, index, content)
+                sizes.append(len(content))
+            continue
+        size = probe_segment_size(segment_url(movie_plan.movie_uuid, movie_plan.resolution, index), timeout)
+        if size is not None:
+            sizes.append(size)
+    if sizes:
+        movie_plan.estimated_bytes = sum(sizes) * segment_count // len(sizes)
+    return transfer
+
+
+def plan_movie(movie_url, quality, timeout, measure_throughput, metadata=None):
+    # A movie that cannot be resolved now stays in the plan unresolved, download() tries again and records the error
+    movie_plan = MoviePlan(movie_url, metadata)
+    if already_downloaded(movie_url):
+        return movie_plan, None
+    try:
+        # The spans go into the movie's own -profile timeline once its download starts
+        with tracer.collect() as movie_plan.trace_spans:
+            if not resolve_movie(movie_plan, quality):
+                return MoviePlan(movie_url), None
+            with tracer.span('size_estimate'):
+                transfer = estimate_movie_size(movie_plan, timeout, measure_throughput)
+        return movie_plan, transfer
+    except Exception as e:
+        logging.error(f"Failed to plan the movie: {movie_url}, error: {e}")
+        return MoviePlan(movie_url), None
+
+
+def order_movie_plans(movie_plans, order, filter_tags):
+    # sorted() is stable, ties keep the listing order
+    if order == 'shortest':
+        # Quick wins first, movies of unknown size last
+        return sorted(movie_plans, key=lambda x: (x.estimated_bytes is None, x.estimated_bytes or 0))
+    if order == 'tags':
+        def matched_tags(movie_plan):
+            tags = [] if movie_plan.metadata is None else movie_plan.metadata.tags
+            return sum(any(tag in genre for genre in tags) for tag in filter_tags)
+        return sorted(movie_plans, key=lambda x: -matched_tags(x))
+    return movie_plans
+
+
+def check_disk_space(movie_plans):
+    # The segments of one movie at a time sit next to the outputs of every movie before it.
+    # Movies that would not fit are dropped from the plan instead of failing halfway through.
+    # Nothing is reserved on disk, this check is the only guard against filling it.
+    free_bytes = shutil.disk_usage(movie_save_path_root).free
+    usable_bytes = free_bytes - DISK_RESERVE_MB * 1024 * 1024
+    output_bytes = 0
+    segment_bytes = 0
+    accepted_plans = []
+    for movie_plan in movie_plans:
+        size = movie_plan.estimated_bytes or 0
+        needed_bytes = output_bytes + size + max(segment_bytes, size)
+        if needed_bytes > usable_bytes:
+            logging.error(f"Not enough disk space for {movie_plan.movie_name}: the batch would need {format_bytes(needed_bytes)} "
+                          f"with it, {format_bytes(max(usable_bytes, 0))} are free (keeping {DISK_RESERVE_MB} MB spare), skipping it.")
+            write_error_to_text_file(movie_plan.movie_url, 'Not enough disk space')
+            continue
+        output_bytes += size
+        segment_bytes = max(segment_bytes, size)
+        accepted_plans.append(movie_plan)
+    return accepted_plans, output_bytes + segment_bytes, free_bytes
+
+
+def plan_downloads(movie_urls, order, filter_tags, quality, timeout, movie_metadata):
+    movie_urls = dedupe_movie_urls(movie_urls)
+    probe_timeout = TIMEOUT if timeout is None else int(timeout)
+    logging.info(f"Planning {len(movie_urls)} movies...")
+    with concurrent_futures.ThreadPoolExecutor(max_workers=PLAN_THREADS) as executor:
+        results = list(executor.map(lambda x: plan_movie(x[1], quality, probe_timeout, segment_cache.enabled or x[0] == 0, movie_metadata.get(x[1])),
+                                    enumerate(movie_urls)))
+
+    movie_plans = order_movie_plans([x[0] for x in results], order, filter_tags)
+    movie_plans, needed_bytes, free_bytes = check_disk_space(movie_plans)
+
+    # Throughput of one connection, the segment download runs one connection per thread
+    transfers = [x[1] for x in results if x[1] is not None]
+    connections = os.cpu_count()
+    rate = None
+    if transfers and sum(x[1] for x in transfers) > 0:
+        rate = sum(x[0] for x in transfers) / sum(x[1] for x in transfers) * connections
+
+    logging.info(f"Download plan ({len(movie_plans)} movies, order: {order}):")
+    total_bytes = 0
+    for i, movie_plan in enumerate(movie_plans, 1):
+        if movie_plan.movie_uuid is None:
+            status = 'already downloaded' if already_downloaded(movie_plan.movie_url) else 'not resolved yet'
+            logging.info(f"{i:>4}. {movie_plan.movie_name:<28} {status}")
+            continue
+        estimated_seconds = None
+        if movie_plan.estimated_bytes is not None:
+            total_bytes += movie_plan.estimated_bytes
+            if rate is not None:
+                estimated_seconds = movie_plan.estimated_bytes / rate
+        logging.info(f"{i:>4}. {movie_plan.movie_name:<28} {movie_plan.final_quality:>6} "
+                     f"{movie_plan.video_offset_max + 1:>6} segments  {format_duration(movie_plan.duration):>9}  "
+                     f"{format_bytes(movie_plan.estimated_bytes):>10}  ~{format_duration(estimated_seconds)}")
+    total_time = 'n/a' if rate is None else f"{format_duration(total_bytes / rate)} at {format_bytes(rate)}/s"
+    logging.info(f"Estimated total: {format_bytes(total_bytes)}, about {total_time}")
+    logging.info(f"Disk space needed at peak: {format_bytes(needed_bytes)}, free: {format_bytes(free_bytes)}")
+    return movie_plans
+
+
 def execute_download(args):
+    ffmpeg = args.ffmpeg
+    cover = args.cover
+    ffcover = args.ffcover
+    profile = args.profile
+    profile_cpu = args.profile_cpu
+    coordinator = args.coordinator
+    local_workers = args.local_workers
+
+    if ffcover:
+        ffmpeg = True
+        cover = True
+
+    if profile is not None:
+        os.makedirs(profile, exist_ok=True)
+        tracer.configure(profile, profile_cpu)
+        logging.info("Profiling enabled, reports will be written to: " + profile)
+
+    configure_segment_sources(args)
+
+    global segment_coordinator
+    worker_processes = []
+    if coordinator is not None or local_workers is not None:
+        segment_coordinator = SegmentCoordinator(coordinator or '127.0.0.1:0')
+        if local_workers is not None:
+            worker_processes = spawn_local_workers(segment_coordinator.address, int(local_workers), args)
+
+    try:
+        download_movie_urls(args, ffmpeg, cover)
+    finally:
+        if segment_coordinator is not None:
+            segment_coordinator.shutdown()
+            segment_coordinator = None
+        for process in worker_processes:
+            process.terminate()
+        for process in worker_processes:
+            process.wait()
+
+
+def configure_segment_sources(args):
+    proxy = args.proxy
+    cache = args.cache
+    cache_size = args.cache_size
+    proxy_pool_list = args.proxy_pool
+    proxy_file = args.proxy_file
+
+    if cache is not None:
+        cache_size_mb = CACHE_SIZE_MB if cache_size is None else int(cache_size)
+        segment_cache.configure(cache, cache_size_mb * 1024 * 1024)
+        logging.info(f"Segment cache enabled: {cache} ({cache_size_mb} MB)")
+
+    if proxy is not None:
+        logging.info("Network proxy enabled.")
+        os.environ["http_proxy"] = f"http://{proxy}"
+        os.environ["https_proxy"] = f"http://{proxy}"
+
+    if proxy_pool_list is not None or proxy_file is not None:
+        proxies = list(proxy_pool_list or [])
+        if proxy_file is not None:
+            proxies += read_proxy_file(proxy_file)
+        proxy_pool.configure(proxies)
+        logging.info(f"Proxy pool enabled for segment downloads ({len(proxies)} proxies).")
+
+
+def download_movie_urls(args, ffmpeg, cover):
     urls = args.urls
     auth = args.auth
     plist = args.plist
     limit = args.limit
-    proxy = args.proxy
-    ffmpeg = args.ffmpeg
-    cover = args.cover
     ffcover = args.ffcover
     search = args.search
     file = args.file
@@ -760,17 +2366,21 @@ def execute_download(args):
     retry = args.retry
     delay = args.delay
     timeout = args.timeout
-
-    if ffcover:
-        ffmpeg = True
-        cover = True
-
-    if proxy is not None:
-        logging.info("Network proxy enabled.")
-        os.environ["http_proxy"] = f"http://{proxy}"
-        os.environ["https_proxy"] = f"http://{proxy}"
+    sync = args.sync
+    order = args.order or 'listing'
+    noplan = args.noplan
 
     movie_urls = []
+    # url -> MovieMetadata of the movie pages the searches already fetched
+    movie_metadata = {}
+    sync_state = None
+    sync_listing_key = None
+    known_urls = None
+
+    if sync:
+        sync_state = load_sync_state()
+        sync_listing_key = plist if plist is not None else 'https://missav.ai/saved#' + auth[0]
+        known_urls = get_sync_known_urls(sync_state, sync_listing_key)
 
     if urls is not None:
         movie_urls = urls
@@ -779,52 +2389,423 @@ def execute_download(args):
         username = auth[0]
         password = auth[1]
         cookie = login_get_cookie({'email': username, 'password': password})
-        movie_urls = get_movie_collections(cookie)
+        movie_urls = get_movie_collections(cookie, known_urls)
         logging.info("The URLs of all the videos you have favorited (total: " + str(len(movie_urls)) + " movies): ")
         for url in movie_urls:
             logging.info(url)
 
     if plist is not None:
-        movie_urls = get_public_playlist(plist, limit)
+        movie_urls = get_public_playlist(plist, limit, known_urls)
         logging.info("The URLs of all videos in this playlist (total: " + str(len(movie_urls)) + " movies): ")
         for url in movie_urls:
             logging.info(url)
 
     if search is not None:
-        url = get_movie_url_by_search(search, filter_tags)
+        url, metadata = get_movie_url_by_search(search, filter_tags)
         if url is not None:
             logging.info("Search " + search + " successfully: " + url)
             movie_urls.append(url)
+            if metadata is not None:
+                movie_metadata[url] = metadata
         else:
             logging.error("Search failed, key: " + search)
             exit(magic_number)
 
     if file is not None:
-        movie_urls = get_urls_from_file(file, filter_tags)
+        movie_urls = get_urls_from_file(file, filter_tags, movie_metadata)
         logging.info("The URLs of all videos in the file (total: " + str(len(movie_urls)) + " movies): ")
         for url in movie_urls:
             logging.info(url)
 
+    crawled_urls = movie_urls
+    if sync:
+        movie_urls = start_sync_run(sync_state, sync_listing_key, crawled_urls)
+        if len(movie_urls) == 0:
+            logging.info("No new movies since the last sync.")
+            return
 
     if (len(movie_urls) == 0):
         logging.error("No urls found.")
         exit(magic_number)
 
-    for url in movie_urls:
-        delete_all_subfolders(movie_save_path_root)
+    movie_urls = dedupe_movie_urls(movie_urls)
+    # A single movie has nothing to order, its probes would only delay the download
+    if noplan or len(movie_urls) == 1:
+        movie_plans = [MoviePlan(url, movie_metadata.get(url)) for url in movie_urls]
+    else:
+        movie_plans = plan_downloads(movie_urls, order, filter_tags, quality, timeout, movie_metadata)
+
+    for movie_plan in movie_plans:
+        url = movie_plan.movie_url
+        delete_all_subfolders(movie_save_path_root, protected_folders())
+        tracer.reset()
+        tracer.replay(movie_plan.trace_spans)
         try:
             logging.info("Processing URL: " + url)
             download(url, ffmpeg_action=ffmpeg, cover_action=cover, title_action=title, cover_as_preview=ffcover,
-                     video_reencode=video_reencode, audio_reencode=audio_reencode, quality=quality, retry=retry, delay=delay, timeout=timeout)
+                     video_reencode=video_reencode, audio_reencode=audio_reencode, quality=quality, retry=retry, delay=delay, timeout=timeout,
+                     movie_plan=movie_plan)
             logging.info("Processing URL Complete: " + url)
             print()
+            if sync:
+                checkpoint_sync_url(sync_state, sync_listing_key, url)
         except Exception as e:
             logging.error(f"Failed to download the movie: {url}, error: {e}")
             write_error_to_text_file(url, e)
-        delete_all_subfolders(movie_save_path_root)
+        tracer.dump(url.split('/')[-1])
+        proxy_pool.log_summary()
+        delete_all_subfolders(movie_save_path_root, protected_folders())
+
+    if sync:
+        finish_sync_run(sync_state, sync_listing_key, crawled_urls)
+
+
+class JobQueue:
+    # Durable download queue, jobs survive restarts of the service.
+    # A job goes queued -> running -> done / failed, or queued -> cancelled.
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    quality TEXT,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    error TEXT,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL
+                )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (state, priority DESC, id)')
+            # Jobs that were running when the service stopped start over
+            recovered = self._db.execute("UPDATE jobs SET state = 'queued', started = NULL WHERE state = 'running'").rowcount
+        if recovered > 0:
+            logging.info(f"Re-queued {recovered} jobs interrupted by the last shutdown.")
+
+    def enqueue(self, urls, priority=0, quality=None):
+        jobs = []
+        with self._lock, self._db:
+            for url in dict.fromkeys(urls):
+                row = self._db.execute("SELECT * FROM jobs WHERE url = ? AND state IN ('queued', 'running')", (url,)).fetchone()
+                if row is None:
+                    cursor = self._db.execute('INSERT INTO jobs (url, priority, quality, created) VALUES (?, ?, ?, ?)',
+                                              (url, priority, quality, time.time()))
+                    row = self._db.execute('SELECT * FROM jobs WHERE id = ?', (cursor.lastrowid,)).fetchone()
+                jobs.append(dict(row))
+        return jobs
+
+    def claim(self):
+        with self._lock, self._db:
+            row = self._db.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE jobs SET state = 'running', started = ? WHERE id = ?", (time.time(), row['id']))
+            return dict(row)
+
+    def finish(self, job_id, state, error=None):
+        with self._lock, self._db:
+            self._db.execute('UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?', (state, error, time.time(), job_id))
+
+    def set_priority(self, job_id, priority):
+        with self._lock, self._db:
+            return self._db.execute('UPDATE jobs SET priority = ? WHERE id = ?', (priority, job_id)).rowcount > 0
+
+    def cancel(self, job_id):
+        with self._lock, self._db:
+            return self._db.execute("UPDATE jobs SET state = 'cancelled', finished = ? WHERE id = ? AND state = 'queued'",
+                                    (time.time(), job_id)).rowcount > 0
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def list(self, state=None, limit=100):
+        with self._lock:
+            if state is None:
+                rows = self._db.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = self._db.execute('SELECT * FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT ?', (state, limit)).fetchall()
+        return [dict(x) for x in rows]
+
+
+class DownloadService:
+    # Long-running downloader: worker threads take jobs from the JobQueue while the HTTP API adds to it.
+    # Everything a batch run sets up again each time (imports, logins, encoder probes, history) stays warm here.
+    def __init__(self, job_queue, download_options, concurrency):
+        self.job_queue = job_queue
+        self.download_options = download_options
+        self.concurrency = concurrency
+        self._wakeup = threading.Condition()
+        self._progress = {}
+        self._cookies = {}
+        self._cookies_lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.concurrency):
+            threading.Thread(target=self._worker_loop, name=f'miyuki-job-worker-{i}', daemon=True).start()
+
+    def notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def get_cookie(self, username, password):
+        with self._cookies_lock:
+            if username not in self._cookies:
+                self._cookies[username] = login_get_cookie({'email': username, 'password': password})
+            return self._cookies[username]
+
+    def progress(self):
+        return {job_id: {'downloaded': x.get_count(), 'total': x.total} for job_id, x in list(self._progress.items())}
+
+    def _worker_loop(self):
+        while True:
+            job = self.job_queue.claim()
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=5)
+                continue
+            self._run_job(job)
+
+    def _run_job(self, job):
+        url = job['url']
+        movie_name = url.split('/')[-1]
+        progress = JobProgress()
+        self._progress[job['id']] = progress
+        current_counter.set(progress)
+        options = dict(self.download_options)
+        if job['quality'] is not None:
+            options['quality'] = job['quality']
+        try:
+            logging.info(f"Job {job['id']} started: {url}")
+            download(url, **options)
+            self.job_queue.finish(job['id'], 'done')
+            logging.info(f"Job {job['id']} completed: {url}")
+        except Exception as e:
+            logging.error(f"Job {job['id']} failed: {url}, error: {e}")
+            write_error_to_text_file(url, e)
+            self.job_queue.finish(job['id'], 'failed', str(e))
+        finally:
+            # Other jobs keep running, so only this movie's segment folder can go
+            shutil.rmtree(os.path.join(movie_save_path_root, movie_name), ignore_errors=True)
+            self._progress.pop(job['id'], None)
+
+
+def make_service_handler(service):
+    job_queue = service.job_queue
+
+    class ServiceHandler(http_server.BaseHTTPRequestHandler):
+        # GET    /jobs[?state=queued]   list jobs
+        # GET    /jobs/<id>             one job
+        # POST   /jobs                  {"urls": [...], "plist": url, "limit": n, "search": key, "auth": [user, password],
+        #                                "priority": n, "quality": "720"}
+        # PATCH  /jobs/<id>             {"priority": n}
+        # DELETE /jobs/<id>             cancel a queued job
+        # GET    /events[?job=<id>]     progress of running jobs as server-sent events, once per second
+        def log_message(self, format, *args):
+            logging.debug('API ' + format % args)
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError('the request body must be a JSON object')
+            return body
+
+        def _route(self):
+            url = urllib.parse.urlsplit(self.path)
+            parts = [x for x in url.path.split('/') if x]
+            query = dict(urllib.parse.parse_qsl(url.query))
+            job_id = None
+            if len(parts) == 2 and parts[1].isdigit():
+                job_id = int(parts[1])
+            return parts[0] if parts else '', job_id, query
+
+        def do_GET(self):
+            resource, job_id, query = self._route()
+            try:
+                limit = int(query.get('limit', 100))
+                event_job_id = int(query['job']) if 'job' in query else None
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            if resource == 'jobs' and job_id is None:
+                self._send_json(200, job_queue.list(query.get('state'), limit))
+            elif resource == 'jobs':
+                job = job_queue.get(job_id)
+                if job is None:
+                    self._send_json(404, {'error': 'job not found'})
+                else:
+                    job['progress'] = service.progress().get(job_id)
+                    self._send_json(200, job)
+            elif resource == 'events':
+                self._stream_events(event_job_id)
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            resource, job_id, _ = self._route()
+            if resource != 'jobs' or job_id is not None:
+                self._send_json(404, {'error': 'not found'})
+                return
+            try:
+                body = self._read_json()
+                priority = int(body.get('priority', 0))
+                quality = body.get('quality')
+                self._check_sources(body)
+            except (ValueError, TypeError, KeyError) as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            try:
+                urls = self._resolve_urls(body)
+            except SystemExit:
+                # login_get_cookie gives up by exiting, which must not take the service down
+                self._send_json(400, {'error': 'login failed'})
+                return
+            except Exception as e:
+                # The listing, search and login pages come from the site, not from the client
+                logging.error(f"API failed to resolve the movie urls: {e}")
+                self._send_json(502, {'error': f'failed to resolve the movie urls: {e}'})
+                return
+            if len(urls) == 0:
+                self._send_json(400, {'error': 'no urls found'})
+                return
+            jobs = job_queue.enqueue(urls, priority, None if quality is None else str(quality))
+            service.notify()
+            self._send_json(201, jobs)
+
+        def do_PATCH(self):
+            resource, job_id, _ = self._route()
+            if resource != 'jobs' or job_id is None:
+                self._send_json(404, {'error': 'not found'})
+                return
+            try:
+                priority = int(self._read_json()['priority'])
+            except (ValueError, TypeError, KeyError) as e:
+                self._send_json(400, {'error': f'priority required: {e}'})
+                return
+            if not job_queue.set_priority(job_id, priority):
+                self._send_json(404, {'error': 'job not found'})
+                return
+            self._send_json(200, job_queue.get(job_id))
+
+        def do_DELETE(self):
+            resource, job_id, _ = self._route()
+            if resource != 'jobs' or job_id is None:
+                self._send_json(404, {'error': 'not found'})
+                return
+            if job_queue.cancel(job_id):
+                self._send_json(200, job_queue.get(job_id))
+            elif job_queue.get(job_id) is None:
+                self._send_json(404, {'error': 'job not found'})
+            else:
+                self._send_json(409, {'error': 'only queued jobs can be cancelled'})
+
+        def _check_sources(self, body):
+            urls = body.get('urls', [])
+            if not isinstance(urls, list) or not all(isinstance(x, str) and re.match(r'https?://', x) for x in urls):
+                raise ValueError('urls must be a list of http(s) urls')
+            for key in ('plist', 'search'):
+                if key in body and not (isinstance(body[key], str) and body[key].strip()):
+                    raise ValueError(f'{key} must be a non-empty string')
+            if 'plist' in body and not re.match(r'https?://', body['plist']):
+                raise ValueError('plist must be an http(s) url')
+            limit = body.get('limit')
+            if limit is not None and not check_positive_integer(str(limit)):
+                raise ValueError('limit must be a positive integer')
+            auth = body.get('auth')
+            if 'auth' in body and not (isinstance(auth, list) and len(auth) == 2 and all(isinstance(x, str) for x in auth)):
+                raise ValueError('auth must be [username, password]')
+
+        def _resolve_urls(self, body):
+            urls = list(body.get('urls', []))
+            if 'plist' in body:
+                limit = body.get('limit')
+                urls += get_public_playlist(body['plist'], None if limit is None else str(limit))
+            if 'search' in body:
+                url, _ = get_movie_url_by_search(body['search'], [])
+                if url is not None:
+                    urls.append(url)
+            if 'auth' in body:
+                username, password = body['auth']
+                urls += get_movie_collections(service.get_cookie(username, password))
+            return urls
+
+        def _stream_events(self, job_id):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                while True:
+                    progress = service.progress()
+                    if job_id is None:
+                        event = progress
+                    else:
+                        job = job_queue.get(job_id)
+                        if job is None:
+                            break
+                        event = {'id': job_id, 'state': job['state'], 'progress': progress.get(job_id)}
+                    self.wfile.write(b'data: ' + json.dumps(event).encode('utf-8') + b'\n\n')
+                    self.wfile.flush()
+                    if job_id is not None and event['state'] not in ('queued', 'running'):
+                        break
+                    time.sleep(1)
+            except OSError:
+                # Client went away
+                pass
+
+    return ServiceHandler
+
+
+def run_service(args):
+    ffmpeg = args.ffmpeg
+    cover = args.cover
+    if args.ffcover:
+        ffmpeg = True
+        cover = True
+
+    configure_segment_sources(args)
+
+    download_options = dict(ffmpeg_action=ffmpeg, cover_action=cover, title_action=args.title, cover_as_preview=args.ffcover,
+                            video_reencode=args.video_reencode, audio_reencode=args.audio_reencode, quality=args.quality,
+                            retry=args.retry, delay=args.delay, timeout=args.timeout)
+    concurrency = 1 if args.concurrency is None else int(args.concurrency)
+    job_queue = JobQueue(args.queue_db or JOB_QUEUE_FILE)
+    service = DownloadService(job_queue, download_options, concurrency)
+    service.start()
+
+    host, port = parse_host_port(args.serve)
+    server = http_server.ThreadingHTTPServer((host, port), make_service_handler(service))
+    logging.info(f"Service listening on http://{host}:{port} with {concurrency} concurrent jobs.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Service stopped.")
+    finally:
+        server.server_close()
 
 
 def main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='Miyuki - %(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
     parser = argparse.ArgumentParser(
         description='A tool for downloading videos from the "MissAV" website.\n'
                     '\n'
@@ -834,10 +2815,13 @@ def main():
                     'Use the -plist  option to specify the public playlist URL to download all videos in the list.\n'
                     'Use the -search option to search for movie by serial number and download it.\n'
                     'Use the -file   option to download all URLs in the file. ( Each line is a URL )\n'
+                    'Use the -serve  option to run as a service with a job queue and a local HTTP API. ( Default 127.0.0.1:8765 )\n'
                     '\n'
                     'Additional Options:\n'
                     'Use the -limit   option to limit the number of downloads. (Only works with the -plist option.)\n'
+                    'Use the -sync    option to only fetch movies added since the last sync. (Only works with the -plist and -auth options.)\n'
                     'Use the -proxy   option to configure http proxy server ip and port.\n'
+                    'Use the -proxy-pool / -proxy-file option to spread segment downloads over several proxies.\n'
                     'Use the -ffmpeg  option to get the best video quality. ( Recommend! )\n'
                     'Use the -cover   option to save the cover when downloading the video\n'
                     'Use the -ffcover option to set the cover as the video preview (ffmpeg required)\n'
@@ -846,7 +2830,21 @@ def main():
                     'Use the -quality option to specify the movie resolution (360, 480, 720, 1080...)\n'
                     'Use the -retry   option to specify the number of retries for downloading segments\n'
                     'Use the -delay   option to specify the delay before retry ( seconds )\n'
-                    'Use the -timeout option to specify the timeout for segment download ( seconds )\n',
+                    'Use the -timeout option to specify the timeout for segment download ( seconds )\n'
+                    'Use the -profile option to write a per-movie timeline ( JSON and Chrome trace ) into a directory\n'
+                    'Use the -cache   option to reuse downloaded segments from a shared cache directory\n'
+                    'Use the -order   option to set the download order of a batch: listing, shortest or tags ( Default listing )\n'
+                    'Use the -noplan  option to skip the size probes and the disk space check before a batch\n'
+                    '\n'
+                    'Distributed Options:\n'
+                    'Use the -coordinator   option to hand segment downloads out to workers listening on HOST:PORT\n'
+                    'Use the -local-workers option to start worker processes on this machine\n'
+                    'Use the -worker        option to run this process as a segment worker of the coordinator at HOST:PORT\n'
+                    '( The coordinator has no authentication, only listen on a trusted network )\n'
+                    '\n'
+                    'Service Options:\n'
+                    'Use the -concurrency option to set how many jobs the service downloads at the same time ( Default 1 )\n'
+                    'Use the -queue-db    option to set the job queue database file ( Default jobs_miyuki.db )\n',
 
 
         epilog='Examples:\n'
@@ -854,11 +2852,19 @@ def main():
                '  miyuki -plist "https://missav.ai/search/JULIA?filters=individual&sort=views" -limit 20 -ffmpeg\n'
                '  miyuki -plist "https://missav.ai/dm132/actresses/JULIA" -limit 20 -ffmpeg -cover\n'
                '  miyuki -plist "https://missav.ai/playlists/ewzoukev" -ffmpeg -proxy localhost:7890\n'
+               '  miyuki -plist "https://missav.ai/dm132/actresses/JULIA" -sync -ffmpeg\n'
                '  miyuki -urls https://missav.ai/sw-950 https://missav.ai/dandy-917\n'
                '  miyuki -urls https://missav.ai/sw-950 -proxy localhost:7890\n'
+               '  miyuki -urls https://missav.ai/sw-950 -proxy-pool localhost:7890 localhost:7891 socks5://10.0.0.2:1080\n'
                '  miyuki -auth miyuki@gmail.com miyukiQAQ -ffmpeg\n'
                '  miyuki -file /home/miyuki/url.txt -ffmpeg\n'
-               '  miyuki -search sw-950 -ffcover\n',
+               '  miyuki -plist "https://missav.ai/playlists/ewzoukev" -order tags -tags uncensored,4k\n'
+               '  miyuki -search sw-950 -ffcover\n'
+               '  miyuki -urls https://missav.ai/sw-950 -local-workers 4 -ffmpeg\n'
+               '  miyuki -urls https://missav.ai/sw-950 -coordinator 0.0.0.0:7000 -ffmpeg    ( on node A )\n'
+               '  miyuki -worker nodeA:7000                                                  ( on every other node )\n'
+               '  miyuki -serve -concurrency 2 -ffmpeg\n'
+               '  curl -X POST localhost:8765/jobs -d \'{"urls": ["https://missav.ai/sw-950"], "priority": 10}\'\n',
         formatter_class=argparse.RawTextHelpFormatter,
     )
 
@@ -866,30 +2872,55 @@ def main():
     parser.add_argument('-auth', nargs='+', required=False, metavar='',help='Username and password, separate with space')
     parser.add_argument('-plist', type=str, required=False, metavar='', help='Public playlist url')
     parser.add_argument('-limit', type=str, required=False, metavar='', help='Limit the number of downloads')
+    parser.add_argument('-sync', action='store_true', required=False, help='Incremental sync, stop at movies seen by the last run')
     parser.add_argument('-search', type=str, required=False, metavar='', help='Movie serial number')
     parser.add_argument('-file', type=str, required=False, metavar='', help='File path')
+    parser.add_argument('-serve', nargs='?', const=SERVICE_ADDRESS, required=False, metavar='', help='Run as a service listening on HOST:PORT')
+    parser.add_argument('-concurrency', type=str, required=False, metavar='', help='Number of jobs the service runs at the same time')
+    parser.add_argument('-queue-db', type=str, required=False, metavar='', help='Job queue database file of the service')
     parser.add_argument('-proxy', type=str, required=False, metavar='', help='HTTP(S) proxy')
+    parser.add_argument('-proxy-pool', nargs='+', required=False, metavar='', help='Proxies for segment downloads, separate with spaces')
+    parser.add_argument('-proxy-file', type=str, required=False, metavar='', help='File of proxies for segment downloads ( Each line is a proxy )')
     parser.add_argument('-ffmpeg', action='store_true', required=False, help='Enable ffmpeg processing')
     parser.add_argument('-cover', action='store_true', required=False, help='Download video cover')
     parser.add_argument('-ffcover', action='store_true', required=False, help='Set cover as preview (ffmpeg required)')
     parser.add_argument('-noban', action='store_true', required=False, help='Do not display the banner')
     parser.add_argument('-title', action='store_true', required=False, help='Full title as file name')
     parser.add_argument('-tags', type=str, required=False, default='', help='Set tags to use when fetching videos, coma separated')
+    parser.add_argument('-order', type=str, required=False, metavar='', help='Download order of a batch: listing, shortest or tags')
+    parser.add_argument('-noplan', action='store_true', required=False, help='Skip the planning stage before a batch')
     parser.add_argument('-video-reencode', action='store_true', required=False, help='Enable Video re-encoding (if available)')
     parser.add_argument('-audio-reencode', action='store_true', required=False, help='Enable Audio re-encoding (if available)')
     parser.add_argument('-quality', type=str, required=False, metavar='', help='Specify the movie resolution')
     parser.add_argument('-retry', type=str, required=False, metavar='', help='Number of retries for downloading segments')
     parser.add_argument('-delay', type=str, required=False, metavar='', help='Delay in seconds before retry')
     parser.add_argument('-timeout', type=str, required=False, metavar='', help='Timeout in seconds for segment download')
+    parser.add_argument('-cache', type=str, required=False, metavar='', help='Shared segment cache directory')
+    parser.add_argument('-cache-size', type=str, required=False, metavar='', help='Segment cache size limit in MB (default 10240)')
+    parser.add_argument('-coordinator', type=str, required=False, metavar='', help='Listen address of the segment coordinator (HOST:PORT)')
+    parser.add_argument('-local-workers', type=str, required=False, metavar='', help='Number of local segment worker processes')
+    parser.add_argument('-worker', type=str, required=False, metavar='', help='Run as a segment worker of the coordinator at HOST:PORT')
+    parser.add_argument('-profile', '--profile', type=str, required=False, metavar='', help='Directory for per-movie timing reports')
+    parser.add_argument('-profile-cpu', action='store_true', required=False, help='Also capture a cProfile of the segment workers (-profile required)')
 
     args = parser.parse_args()
 
+    if args.worker is not None:
+        if not check_address(args.worker):
+            logging.error("The -worker option accepts only HOST:PORT.")
+            exit(magic_number)
+        run_segment_worker(args)
+        return
+
     validate_args(args)
 
     if not args.noban:
         print(banner)
 
-    execute_download(args)
+    if args.serve is not None:
+        run_service(args)
+    else:
+        execute_download(args)
 
 
 if __name__ == "__main__":